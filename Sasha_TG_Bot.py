@@ -1,22 +1,44 @@
 import logging
 import os
-import pyshorteners
+import sys
 from moviepy import *
 from moviepy.video.fx import Crop
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+import imageio_ffmpeg
+import proglog
+import httpx
 from typing import cast
 import time
 import subprocess
 import numpy as np
 import asyncio
-import requests
+import contextlib
 import json
+import pickle
+import csv
+import io
+import hashlib
+import hmac
+import sqlite3
+import re
+import multiprocessing
+import shutil
+import tempfile
+from collections import deque, OrderedDict
+from urllib.parse import urlsplit, urlunsplit, urlparse, urlunparse, parse_qs, parse_qsl, urlencode, quote
+import signal
+import socket
+from PIL import Image as PILImage, ImageEnhance
 
 from telegram import (
-    Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InputFile, Bot
+    Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InputFile, Bot,
+    InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle, InputTextMessageContent,
+    InlineQueryResultsButton
 )
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler,
-    ContextTypes, filters, ConversationHandler
+    ContextTypes, filters, ConversationHandler, CallbackQueryHandler, InlineQueryHandler,
+    BasePersistence, PersistenceInput, BaseUpdateProcessor
 )
 
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
@@ -28,15 +50,206 @@ CHOOSING, SHORTEN, VIDEO, VINYL_IMAGE, VINYL_AUDIO, UTM_URL, UTM_SOURCE, UTM_CAM
 
 UTM_SOURCE_CHOICE, UTM_CAMPAIGN_CHOICE, UTM_PLATFORM_CHOICE = range(8, 11)
 
+VIDEO_PREVIEW, VINYL_PREVIEW = range(11, 13)
+
 VK_ACCESS_TOKEN = os.getenv('VK_ACCESS_TOKEN')
 # VK_ACCESS_TOKEN = "token for debug"
 VK_API_VERSION = "5.199"
-VK_SHORTLINK_URL = "https://api.vk.com/method/utils.getShortLink"
+VK_SHORTLINK_URL = os.getenv('VK_SHORTLINK_URL', "https://api.vk.com/method/utils.getShortLink")
+
+# URL shortening (per-provider timeouts in seconds)
+TINYURL_API_URL = os.getenv('TINYURL_API_URL', "https://tinyurl.com/api-create.php")
+TINYURL_TIMEOUT = float(os.getenv('TINYURL_TIMEOUT', '5'))
+VK_TIMEOUT = float(os.getenv('VK_TIMEOUT', '5'))
+SHORT_LINK_CACHE_PATH = os.getenv('SHORT_LINK_CACHE_PATH', 'short_links.sqlite3')
+SHORT_LINK_CACHE_TTL = int(os.getenv('SHORT_LINK_CACHE_TTL', str(7 * 24 * 3600)))
+SHORT_LINK_CACHE_MAX_ENTRIES = int(os.getenv('SHORT_LINK_CACHE_MAX_ENTRIES', '50000'))  # On disk
+SHORT_LINK_CACHE_MEMORY_ENTRIES = 1024
+SHORTENER_DEFAULT = os.getenv('SHORTENER_DEFAULT', 'tinyurl')  # For plain links; users can switch with /shortener
+
+# Built-in short links: SQLite store plus a redirect server, in the bot process or as `redirect-server` on the same host
+LOCAL_SHORTENER_BASE_URL = os.getenv('LOCAL_SHORTENER_BASE_URL')  # Public address of the redirect server; unset disables 'local'
+LOCAL_SHORTENER_PATH = os.getenv('LOCAL_SHORTENER_PATH', 'local_links.sqlite3')
+LOCAL_SHORTENER_HOST = os.getenv('LOCAL_SHORTENER_HOST', '0.0.0.0')
+LOCAL_SHORTENER_PORT = int(os.getenv('LOCAL_SHORTENER_PORT') or os.getenv('PORT', '8080'))  # An explicit setting wins over $PORT
+LOCAL_SHORTENER_IN_PROCESS = os.getenv('LOCAL_SHORTENER_IN_PROCESS', '0') == '1'
+LOCAL_SHORTENER_HOT_ENTRIES = 4096  # Codes kept in memory for redirects
+BASE62_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+# Shortener health: rolling stats, circuit breakers and hedged fallbacks
+SHORTENER_HEALTH_WINDOW = 50  # Recent calls kept per provider
+SHORTENER_BREAKER_FAILURES = 5  # Consecutive failures that open a provider's circuit
+SHORTENER_BREAKER_ERROR_RATE = 0.5  # Or this error rate over at least 10 recent calls
+SHORTENER_BREAKER_COOLDOWN = int(os.getenv('SHORTENER_BREAKER_COOLDOWN', '60'))
+SHORTENER_HEDGING = os.getenv('SHORTENER_HEDGING', '1') == '1'
+SHORTENER_HEDGE_MIN_DELAY = 0.2
+SHORTENER_HEDGE_DEFAULT_DELAY = 1.0  # Until a provider has enough samples for a p95
+TINYURL_RATE_LIMIT = float(os.getenv('TINYURL_RATE_LIMIT', '5'))  # Requests per second
+VK_RATE_LIMIT = float(os.getenv('VK_RATE_LIMIT', '3'))  # VK API allows 3 requests per second per token
+
+# Bulk shortening
+BULK_SHORTEN_MAX_URLS = int(os.getenv('BULK_SHORTEN_MAX_URLS', '1000'))
+BULK_SHORTEN_MAX_FILE_MB = 1
+BULK_SHORTEN_CONCURRENCY = int(os.getenv('BULK_SHORTEN_CONCURRENCY', '8'))
+BULK_PROGRESS_INTERVAL = 3  # Seconds between progress message edits
+URL_PATTERN = re.compile(r'https?://[^\s,;"\'<>]+')
+UTM_MATRIX_PATTERN = re.compile(r'^\s*(sources?|campaigns?|mediums?|platform)\s*[:=]\s*(.+)$', re.IGNORECASE | re.MULTILINE)
+
+# Inline mode (@bot <url> [campaign]); needs inline mode enabled with @BotFather /setinline
+INLINE_DEBOUNCE_SECONDS = 0.6  # Queries superseded within this window are never answered
+INLINE_ANSWER_BUDGET = float(os.getenv('INLINE_ANSWER_BUDGET', '2'))  # Seconds from query to answer, slow providers or not
+INLINE_CACHE_TIME = 300  # Seconds Telegram may reuse an answer with every link shortened
+INLINE_PENDING_CACHE_TIME = 2  # Answers still carrying full links, so a retry picks up the short ones
+INLINE_UTM_SOURCES = ['yandex', 'vk', 'google']
+
+# Vinyl
+VINYL_OVERLAY_PATH = "vinyl_overlay.png"
+VINYL_STRENGTH = 0.4
+VINYL_FPS = 24
+VINYL_DEGREES_PER_SECOND = 12
+VINYL_FRAME_CACHE = os.getenv('VINYL_FRAME_CACHE', '1') == '1'
+VINYL_FRAME_CACHE_MB = int(os.getenv('VINYL_FRAME_CACHE_MB', '256'))
+VINYL_AUDIO_BITRATE = "128k"
+
+# Streaming ingest (uploads up to this size are piped into ffmpeg as they download; 0 disables)
+STREAM_INGEST_MAX_MB = float(os.getenv('STREAM_INGEST_MAX_MB', '20'))
+STREAM_INGEST_CHUNK = 64 * 1024
+STREAM_INGEST_TIMEOUT = 60
+STREAMABLE_AUDIO_EXTENSIONS = {'mp3', 'ogg', 'oga', 'opus', 'wav', 'flac', 'aac'}  # No trailing index to seek to
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '20'))
+
+# Rendering
+RENDER_BACKENDS = ('moviepy', 'ffmpeg')
+RENDER_BACKEND = os.getenv('RENDER_BACKEND', 'moviepy')
+FFMPEG_BINARY = imageio_ffmpeg.get_ffmpeg_exe()
+VIDEO_NOTE_FPS = 24
+VIDEO_NOTE_MAX_LENGTH = 640  # Largest video note diameter Telegram accepts
+VIDEO_NOTE_AUDIO_KBPS = 128
+
+# Encoding profiles (x264 preset, constant quality capped by maxrate)
+ENCODING_PROFILES = {
+    'fast': {'preset': 'veryfast', 'crf': 30, 'maxrate': '600k'},
+    'balanced': {'preset': 'medium', 'crf': 26, 'maxrate': '1000k'},
+    'quality': {'preset': 'slow', 'crf': 22, 'maxrate': '1600k'},
+    'target': {'preset': 'medium'},  # Average bitrate sized to fit ENCODING_TARGET_MB
+    'preview': {'preset': 'ultrafast', 'crf': 32, 'maxrate': '400k'},
+}
+# Profiles a user can pick with /profile; 'preview' is only for draft previews
+ENCODING_PROFILE_CHOICES = [name for name in ENCODING_PROFILES if name != 'preview']
+ENCODING_PROFILE = os.getenv('ENCODING_PROFILE', 'balanced')
+ENCODING_TARGET_MB = float(os.getenv('ENCODING_TARGET_MB', '8'))
+ENCODING_MAX_KBPS = 2500
+ENCODING_FAST_QUEUE_DEPTH = int(os.getenv('ENCODING_FAST_QUEUE_DEPTH', '3'))  # Waiting jobs before falling back to 'fast'
+TELEGRAM_UPLOAD_LIMIT_MB = 50
+
+# Draft previews shown before a full render
+PREVIEW_ENABLED = os.getenv('PREVIEW_ENABLED', '1') == '1'
+PREVIEW_SECONDS = 3
+PREVIEW_SIZE = 240
+
+# Render scheduler (global worker count, per-user running and queued job caps)
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', os.cpu_count() or 1))
+RENDER_USER_RUNNING_LIMIT = int(os.getenv('RENDER_USER_RUNNING_LIMIT', '1'))
+RENDER_USER_QUEUE_LIMIT = int(os.getenv('RENDER_USER_QUEUE_LIMIT', '2'))  # Running + waiting jobs per user
+
+# Render job queue: with RENDER_QUEUE=1 renders run in separate `render-worker` processes.
+# Single host only: workers share the queue file and WORKSPACE_ROOT with the bot, so they must be started
+# next to it (same container or supervisor); separate Heroku dynos have separate filesystems.
+RENDER_QUEUE_ENABLED = os.getenv('RENDER_QUEUE', '0') == '1'
+RENDER_QUEUE_PATH = os.getenv('RENDER_QUEUE_PATH', 'render_queue.sqlite3')
+RENDER_QUEUE_SLOTS = int(os.getenv('RENDER_QUEUE_SLOTS', '8'))  # Jobs the bot hands out at once; the scheduler picks which
+RENDER_QUEUE_LEASE_SECONDS = float(os.getenv('RENDER_QUEUE_LEASE_SECONDS', '30'))  # Without a heartbeat, a job is reclaimed
+# and with no worker seen for this long, queued jobs fail instead of waiting forever
+RENDER_QUEUE_MAX_ATTEMPTS = 3  # Claims before a job that keeps killing its worker is failed
+RENDER_QUEUE_HEARTBEAT = 1.0  # Seconds between worker heartbeats, which also carry progress
+RENDER_QUEUE_POLL_INTERVAL = 0.25
+RENDER_QUEUE_RETENTION = 24 * 3600  # Rows older than this are left over from a previous bot process
+
+# Render deadlines (seconds from submission; 0 disables)
+RENDER_DEADLINE_SECONDS = float(os.getenv('RENDER_DEADLINE_SECONDS', '120'))
+RENDER_DEADLINE_SAMPLE_SECONDS = 2  # Progress needed before projecting a finish time
+RENDER_DEADLINE_MIN_SECONDS = 10  # Shortest clip a deadline may cut a render down to
+RENDER_PROGRESS_INTERVAL = 0.5
+
+# Job workspaces
+WORKSPACE_ROOT = os.getenv('WORKSPACE_ROOT')
+WORKSPACE_QUOTA_MB = int(os.getenv('WORKSPACE_QUOTA_MB', '1024'))
+WORKSPACE_OUTPUT_ALLOWANCE = 16 * 1024 * 1024  # Room for renders and intermediates per job
+WORKSPACE_IDLE_SECONDS = int(os.getenv('WORKSPACE_IDLE_SECONDS', '1800'))  # Abandoned sessions give their files and quota back
+WORKSPACE_SWEEP_INTERVAL = 60
+
+# Conversation state and user_data persistence
+PERSISTENCE_ENABLED = os.getenv('PERSISTENCE_ENABLED', '1') == '1'
+PERSISTENCE_PATH = os.getenv('PERSISTENCE_PATH', 'bot_state.sqlite3')
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', '5'))  # Seconds between batched writes
+PERSISTENCE_CONVERSATION_TTL = 7 * 24 * 3600  # Conversations idle longer restart from /start
+WORKSPACE_RESUME_SECONDS = 3600  # Job files younger than this survive a restart for resumed sessions
+
+# Update processing: users run concurrently, each user's updates strictly in order
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '64'))  # Updates handled at once
+UPDATE_CHAT_CONCURRENCY = int(os.getenv('UPDATE_CHAT_CONCURRENCY', '4'))  # Per chat, for groups with many users
+UPDATE_MAX_PENDING = 10000  # Updates admitted and waiting for their turn
+
+# Webhook mode: set WEBHOOK_URL (public https URL Telegram posts to) instead of long polling.
+# On Heroku-style hosts only the `web` process type gets $PORT and HTTP traffic, so run the bot as
+# `web: python Sasha_TG_Bot.py` in place of the Procfile's polling `worker` entry.
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT') or os.getenv('PORT', '8443'))  # An explicit setting wins over $PORT
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()  # Same on every instance
+WEBHOOK_MAX_BODY = 1024 * 1024
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))  # Concurrent deliveries Telegram may open
+WEBHOOK_RECORD_PATH = os.getenv('WEBHOOK_RECORD_PATH')  # Append accepted updates here, one JSON per line, for replay
+# Both default to $PORT: then the webhook server also answers short link redirects
+REDIRECTS_ON_WEBHOOK = bool(WEBHOOK_URL) and LOCAL_SHORTENER_IN_PROCESS and LOCAL_SHORTENER_PORT == WEBHOOK_PORT
+
+# Render result cache
+RENDER_CACHE_PATH = os.getenv('RENDER_CACHE_PATH', 'render_cache.sqlite3')
+RENDER_CACHE_VERSION = 2  # Bump when renderer output or the key layout changes
 
 # Keyboard
 reply_keyboard = [['🔗', '🔗 UTM', '📷', '💿', '🛑']]
 markup = ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True)
 
+preview_markup = InlineKeyboardMarkup([[
+    InlineKeyboardButton("✅ Render full", callback_data="preview:confirm"),
+    InlineKeyboardButton("🔁 Redo", callback_data="preview:redo"),
+]])
+
+# In-process counters and timings for dashboards (/stats)
+class Metrics:
+    """Named counters plus count/total/max timings"""
+    
+    def __init__(self):
+        self.counters = {}
+        self.timings = {}
+    
+    def increment(self, name: str, value: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+    
+    def observe(self, name: str, seconds: float) -> None:
+        timing = self.timings.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+        timing['count'] += 1
+        timing['total'] += seconds
+        timing['max'] = max(timing['max'], seconds)
+    
+    def snapshot(self) -> dict:
+        return {
+            'counters': dict(self.counters),
+            'timings': {
+                name: {**timing, 'avg': timing['total'] / timing['count']}
+                for name, timing in self.timings.items()
+            },
+        }
+    
+    def format(self) -> str:
+        lines = [f"{name}: {value}" for name, value in sorted(self.counters.items())]
+        for name, timing in sorted(self.snapshot()['timings'].items()):
+            lines.append(f"{name}: n={timing['count']} avg={timing['avg']:.3f}s max={timing['max']:.3f}s")
+        return "\n".join(lines) or "No metrics yet"
+
+metrics = Metrics()
+
 # Start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text("Welcome! Choose an option:", reply_markup=markup)
@@ -44,6 +257,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 # Stop command
 async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    render_scheduler.cancel(update.effective_user.id)
+    release_vinyl_workspace(context)
+    release_video_workspace(context)
+    context.user_data['state'] = ConversationHandler.END
     await update.message.reply_text("Session stopped. Use /start to begin again.", reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
@@ -61,6 +278,8 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             UTM_SOURCE: "Waiting for UTM Source",
             UTM_CAMPAIGN: "Waiting for UTM Campaign",
             UTM_PLATFORM_CHOICE: "Choosing UTM Platform",
+            VIDEO_PREVIEW: "Reviewing Video Preview",
+            VINYL_PREVIEW: "Reviewing Vinyl Preview",
         }
         current_state = state_map.get(context.user_data['state'], "Unknown")
     
@@ -69,23 +288,97 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     menu_text += "/start - Start the bot\n"
     menu_text += "/stop - Stop the session\n"
     menu_text += "/menu - Show this menu\n"
-    menu_text += "/cancel - Cancel current operation"
+    menu_text += "/cancel - Cancel current operation\n"
+    menu_text += "/backend - Choose the render backend\n"
+    menu_text += "/profile - Choose the encoding profile\n"
+    menu_text += "/shortener - Choose the link shortener\n"
+    menu_text += "/stats - Show bot metrics"
     
     await update.message.reply_text(menu_text)
     # Return current state or CHOOSING if unknown
     return context.user_data.get('state', CHOOSING)
 
+# Stats command
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text(
+        f"📈 Bot metrics\n\n{render_scheduler.format_stats()}\n"
+        + (f"{render_job_queue.format_stats()}\n" if RENDER_QUEUE_ENABLED else "")
+        + f"{short_link_cache.format_stats()}\n"
+        f"{format_shortener_health()}\n\n{metrics.format()}"
+    )
+    return context.user_data.get('state', CHOOSING)
+
+# Backend command
+async def set_backend(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    backend = context.args[0].lower() if context.args else None
+    
+    if backend in RENDER_BACKENDS:
+        context.user_data['render_backend'] = backend
+        await update.message.reply_text(f"Render backend set to {backend} for your next jobs.")
+    else:
+        current_backend = context.user_data.get('render_backend', RENDER_BACKEND)
+        await update.message.reply_text(
+            f"Current render backend: {current_backend}\n"
+            f"Usage: /backend {' | '.join(RENDER_BACKENDS)}"
+        )
+    
+    return context.user_data.get('state', CHOOSING)
+
+# Encoding profile command
+async def set_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    profile = context.args[0].lower() if context.args else None
+    
+    if profile in ENCODING_PROFILE_CHOICES:
+        context.user_data['encoding_profile'] = profile
+        await update.message.reply_text(f"Encoding profile set to {profile} for your next jobs.")
+    else:
+        current_profile = context.user_data.get('encoding_profile', ENCODING_PROFILE)
+        await update.message.reply_text(
+            f"Current encoding profile: {current_profile}\n"
+            f"Usage: /profile {' | '.join(ENCODING_PROFILE_CHOICES)}"
+        )
+    
+    return context.user_data.get('state', CHOOSING)
+
+# Shortener command
+async def set_shortener(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    shortener = context.args[0].lower() if context.args else None
+    choices = list(SHORTENER_CHOICES)
+    
+    if shortener in choices:
+        context.user_data['shortener'] = shortener
+        await update.message.reply_text(f"Link shortener set to {shortener} for your next links.")
+    else:
+        await update.message.reply_text(
+            f"Current link shortener: {context.user_data.get('shortener', SHORTENER_DEFAULT)}\n"
+            f"Usage: /shortener {' | '.join(choices)}"
+        )
+    
+    return context.user_data.get('state', CHOOSING)
+
+# Providers for the user's plain (non-UTM) links
+def user_shortener(context: ContextTypes.DEFAULT_TYPE) -> list:
+    return SHORTENER_CHOICES.get(context.user_data.get('shortener', SHORTENER_DEFAULT), ['tinyurl'])
+
 # Handle choice
 async def choose_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     choice = update.message.text
     context.user_data['state'] = CHOOSING
 
     if choice == '🔗':
-        await update.message.reply_text("Send the URL to shorten:", reply_markup=ReplyKeyboardRemove())
+        await update.message.reply_text(
+            "Send the URL to shorten, or several URLs (one per line, or a .txt/.csv file) to shorten in bulk:",
+            reply_markup=ReplyKeyboardRemove()
+        )
         context.user_data['state'] = SHORTEN
         return SHORTEN
     elif choice == '🔗 UTM':
-        await update.message.reply_text("Creating UTM tracking URL!\n\nFirst, send the URL you want to track:", reply_markup=ReplyKeyboardRemove())
+        await update.message.reply_text(
+            "Creating UTM tracking URL!\n\nFirst, send the URL you want to track.\n\n"
+            "For a batch, send the URL(s) with comma-separated lists instead:\n"
+            "source: vk, telegram\ncampaign: spring_sale, launch\nmedium: smm, cpc\nplatform: vk",
+            reply_markup=ReplyKeyboardRemove()
+        )
         context.user_data['state'] = UTM_URL
         # Clear any previous UTM data
         context.user_data.pop('utm_url', None)
@@ -100,8 +393,7 @@ async def choose_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         await update.message.reply_text("Creating a vinyl record!\n\nFirst, send an image for the vinyl cover:", reply_markup=ReplyKeyboardRemove())
         context.user_data['state'] = VINYL_IMAGE
         # Clear any previous vinyl data
-        context.user_data.pop('vinyl_image_path', None)
-        context.user_data.pop('vinyl_audio_path', None)
+        release_vinyl_workspace(context)
         return VINYL_IMAGE
     elif choice == '🛑':
         return await stop(update, context)
@@ -112,8 +404,14 @@ async def choose_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 # Handle URL shortening
 async def shorten_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     long_url = update.message.text
+    
+    # Several links in one message: shorten them all into a CSV
+    urls = URL_PATTERN.findall(long_url)
+    if len(urls) > 1:
+        return await shorten_bulk(update, context, urls)
+    
     try:
-        short_url = pyshorteners.Shortener().tinyurl.short(long_url)
+        short_url, _ = await shorten_link(long_url, user_shortener(context))
         await update.message.reply_text(f"Shortened URL:\n{short_url}")
     except Exception as e:
         await update.message.reply_text(f"Error: {str(e)}")
@@ -122,10 +420,166 @@ async def shorten_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     context.user_data['state'] = CHOOSING
     return CHOOSING
 
+# Handle a .txt/.csv document of URLs to shorten
+async def shorten_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    document = update.message.document
+    if document.file_size and document.file_size > BULK_SHORTEN_MAX_FILE_MB * 1024 * 1024:
+        await update.message.reply_text(f"The file is too large (max {BULK_SHORTEN_MAX_FILE_MB}MB).")
+        return SHORTEN
+    
+    file = await document.get_file()
+    content = bytes(await file.download_as_bytearray()).decode('utf-8-sig', errors='replace')
+    urls = URL_PATTERN.findall(content)
+    if not urls:
+        await update.message.reply_text("No http:// or https:// links found in the file.")
+        return SHORTEN
+    return await shorten_bulk(update, context, urls)
+
+# Shorten many URLs concurrently, with throttled progress edits of processing_msg
+async def shorten_many(urls: list, providers: list, processing_msg=None) -> dict:
+    """Return {url: (short_url, provider name, error)} for every url"""
+    results = {}
+    last_progress = time.perf_counter()
+    semaphore = asyncio.Semaphore(BULK_SHORTEN_CONCURRENCY)
+    
+    async def shorten_one(url: str):
+        nonlocal last_progress
+        async with semaphore:
+            try:
+                results[url] = (*await shorten_link(url, providers), "")
+            except ShortenerError as e:
+                results[url] = ("", "", str(e))
+        
+        # Throttled progress
+        if processing_msg and time.perf_counter() - last_progress >= BULK_PROGRESS_INTERVAL and len(results) < len(urls):
+            last_progress = time.perf_counter()
+            try:
+                await processing_msg.edit_text(f"🔗 Shortened {len(results)}/{len(urls)} links...")
+            except Exception:
+                pass  # Ignore unchanged or deleted messages
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(shorten_one(url) for url in urls))
+    metrics.increment('bulk_shorten.links', len(urls))
+    metrics.observe('bulk_shorten', time.perf_counter() - started)
+    return results
+
+# Reply with rows as a CSV document
+async def send_csv_document(update: Update, header: list, rows: list, filename: str, caption: str) -> None:
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(header)
+    writer.writerows(rows)
+    await update.message.reply_document(document=output.getvalue().encode('utf-8'), filename=filename, caption=caption)
+
+# Shorten many URLs concurrently and reply with a CSV of the results
+async def shorten_bulk(update: Update, context: ContextTypes.DEFAULT_TYPE, urls: list) -> int:
+    # De-duplicate, keeping the first occurrence's order
+    unique_urls = list(dict.fromkeys(url.rstrip('.)') for url in urls))
+    duplicates = len(urls) - len(unique_urls)
+    if len(unique_urls) > BULK_SHORTEN_MAX_URLS:
+        await update.message.reply_text(f"Too many links: {len(unique_urls)} (max {BULK_SHORTEN_MAX_URLS}).")
+        return SHORTEN
+    
+    render_scheduler.track(update.effective_user.id)  # So /cancel stops the batch
+    processing_msg = await update.message.reply_text(f"🔗 Shortening {len(unique_urls)} links...")
+    started = time.perf_counter()
+    try:
+        results = await shorten_many(unique_urls, user_shortener(context), processing_msg)
+    except asyncio.CancelledError:
+        # /cancel or /stop already replied
+        return context.user_data.get('state', CHOOSING)
+    finally:
+        try:
+            await processing_msg.delete()
+        except:
+            pass  # Ignore if message can't be deleted
+    
+    # One CSV with every link, in input order
+    failed = sum(1 for url in unique_urls if results[url][2])
+    await send_csv_document(
+        update,
+        ['original_url', 'short_url', 'provider', 'error'],
+        [[url, *results[url]] for url in unique_urls],
+        "short_links.csv",
+        f"✂️ {len(unique_urls) - failed} of {len(unique_urls)} links shortened in {time.perf_counter() - started:.1f}s"
+        + (f", {duplicates} duplicates skipped" if duplicates else "")
+        + (f", {failed} failed" if failed else "")
+    )
+    await update.message.reply_text("What next?", reply_markup=markup)
+    context.user_data['state'] = CHOOSING
+    return CHOOSING
+
+# Build, shorten and export every URL × source × campaign × medium combination
+async def generate_utm_matrix(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> int:
+    base_urls = list(dict.fromkeys(URL_PATTERN.findall(text)))
+    fields = {'source': [], 'campaign': [], 'medium': [], 'platform': []}
+    for key, values in UTM_MATRIX_PATTERN.findall(text):
+        key = key.lower().rstrip('s') if key.lower() != 'platform' else 'platform'
+        fields[key].extend(value.strip() for value in values.split(',') if value.strip())
+    sources = list(dict.fromkeys(fields['source']))
+    campaigns = list(dict.fromkeys(fields['campaign']))
+    mediums = list(dict.fromkeys(fields['medium'])) or ['smm']
+    
+    if not base_urls or not sources or not campaigns:
+        await update.message.reply_text(
+            "For a UTM batch send the URL(s) plus at least a source and a campaign line, e.g.:\n\n"
+            "https://example.com/landing\nsource: vk, telegram\ncampaign: spring_sale\nmedium: smm, cpc"
+        )
+        return UTM_URL
+    
+    total = len(base_urls) * len(sources) * len(campaigns) * len(mediums)
+    if total > BULK_SHORTEN_MAX_URLS:
+        await update.message.reply_text(f"Too many combinations: {total} (max {BULK_SHORTEN_MAX_URLS}).")
+        return UTM_URL
+    
+    # Each base URL is parsed once, then reused for all of its combinations
+    rows = []
+    for base_url in base_urls:
+        build = utm_url_builder(base_url)
+        for source in sources:
+            for campaign in campaigns:
+                for medium in mediums:
+                    rows.append([base_url, source, campaign, medium, build(source, campaign, medium)])
+    
+    platform = fields['platform'][0].lower() if fields['platform'] else 'other'
+    providers = SHORTENER_CHOICES.get(platform, ['tinyurl'])
+    
+    render_scheduler.track(update.effective_user.id)  # So /cancel stops the batch
+    processing_msg = await update.message.reply_text(f"🔗 Creating {total} UTM links...")
+    started = time.perf_counter()
+    try:
+        results = await shorten_many(list(dict.fromkeys(row[4] for row in rows)), providers, processing_msg)
+    except asyncio.CancelledError:
+        return context.user_data.get('state', CHOOSING)
+    finally:
+        try:
+            await processing_msg.delete()
+        except:
+            pass  # Ignore if message can't be deleted
+    
+    failed = sum(1 for row in rows if results[row[4]][2])
+    await send_csv_document(
+        update,
+        ['base_url', 'utm_source', 'utm_campaign', 'utm_medium', 'utm_url', 'short_url', 'provider', 'error'],
+        [[*row, *results[row[4]]] for row in rows],
+        "utm_links.csv",
+        f"🔗 {total} UTM links ({len(base_urls)} URLs × {len(sources)} sources × {len(campaigns)} campaigns × "
+        f"{len(mediums)} mediums) in {time.perf_counter() - started:.1f}s" + (f", {failed} failed" if failed else "")
+    )
+    
+    await update.message.reply_text("What next?", reply_markup=markup)
+    context.user_data['state'] = CHOOSING
+    return CHOOSING
+
 # Handle UTM URL input
 async def handle_utm_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     url = update.message.text.strip()
     
+    # Batch mode: URL(s) plus source/campaign/medium lists in one message
+    if UTM_MATRIX_PATTERN.search(url):
+        return await generate_utm_matrix(update, context, url)
+    
     # Basic URL validation
     if not (url.startswith('http://') or url.startswith('https://')):
         await update.message.reply_text("Please send a valid URL starting with http:// or https://")
@@ -249,13 +703,16 @@ async def handle_utm_campaign_choice(update: Update, context: ContextTypes.DEFAU
     context.user_data['utm_campaign'] = campaign
     return await proceed_to_platform_choice(update, context)
 
-async def proceed_to_platform_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    # Create platform selection keyboard
+# Platform selection keyboard; 'Local' only when the built-in shortener has a public address
+def platform_keyboard_markup() -> ReplyKeyboardMarkup:
     platform_keyboard = [
         ['VK', 'Facebook'],
-        ['Other']
+        ['Local', 'Other'] if LOCAL_SHORTENER_BASE_URL else ['Other']
     ]
-    platform_markup = ReplyKeyboardMarkup(platform_keyboard, one_time_keyboard=True, resize_keyboard=True)
+    return ReplyKeyboardMarkup(platform_keyboard, one_time_keyboard=True, resize_keyboard=True)
+
+async def proceed_to_platform_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    platform_markup = platform_keyboard_markup()
     
     await update.message.reply_text(
         "✅ Campaign details received!\n\n"
@@ -269,19 +726,14 @@ async def proceed_to_platform_choice(update: Update, context: ContextTypes.DEFAU
 async def handle_utm_platform_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     choice = update.message.text.strip()
     
-    if choice in ['VK', 'Facebook', 'Other']:
+    if choice in ['VK', 'Facebook', 'Other'] or (choice == 'Local' and LOCAL_SHORTENER_BASE_URL):
         context.user_data['utm_platform'] = choice.lower()
         
         # Generate the final UTM URL based on platform
         return await generate_utm_final_url_with_platform(update, context)
     else:
         # Invalid choice, show options again
-        platform_keyboard = [
-            ['VK', 'Facebook'],
-            ['Other']
-        ]
-        platform_markup = ReplyKeyboardMarkup(platform_keyboard, one_time_keyboard=True, resize_keyboard=True)
-        await update.message.reply_text("Please select from the options below:", reply_markup=platform_markup)
+        await update.message.reply_text("Please select from the options below:", reply_markup=platform_keyboard_markup())
         return UTM_PLATFORM_CHOICE
 
 # New function to generate final UTM URL with platform-specific shortening
@@ -299,19 +751,11 @@ async def generate_utm_final_url_with_platform(update: Update, context: ContextT
         # Send processing message
         processing_msg = await update.message.reply_text("🔗 Creating your UTM tracking URL...")
         
-        # Shorten the UTM URL based on platform
-        if platform == 'vk':
-            short_url = await shorten_with_vk_api(utm_url)
-            if not short_url:
-                # Fallback to TinyURL if VK API fails
-                short_url = pyshorteners.Shortener().tinyurl.short(utm_url)
-                platform_info = "VK (fallback to TinyURL)"
-            else:
-                platform_info = "VK"
-        else:
-            # Use TinyURL for Facebook and Other
-            short_url = pyshorteners.Shortener().tinyurl.short(utm_url)
-            platform_info = "TinyURL"
+        # Shorten the UTM URL based on platform (TinyURL for Facebook and Other)
+        providers = SHORTENER_CHOICES.get(platform, ['tinyurl'])
+        short_url, provider_name = await shorten_link(utm_url, providers)
+        preferred_name = SHORTENERS[providers[0]].name
+        platform_info = provider_name if provider_name == preferred_name else f"{preferred_name} (fallback to {provider_name})"
         
         # Delete processing message
         try:
@@ -344,34 +788,622 @@ async def generate_utm_final_url_with_platform(update: Update, context: ContextT
     context.user_data['state'] = CHOOSING
     return CHOOSING
 
-# New function to shorten URL using VK API
-async def shorten_with_vk_api(url: str) -> str:
-    """Shorten URL using VK API"""
-    try:
+# Raised when a shortening provider fails or returns something unusable
+class ShortenerError(Exception):
+    pass
+
+# Rolling latency/error statistics and a circuit breaker for one provider
+class ProviderHealth:
+    """Closed: calls go through. Open: skipped until the cooldown ends. Half-open: one trial call decides"""
+    
+    def __init__(self):
+        self.samples = deque(maxlen=SHORTENER_HEALTH_WINDOW)  # (ok, seconds)
+        self.consecutive_failures = 0
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.probing = False
+    
+    def available(self) -> bool:
+        """Whether allow() would let a call through, without claiming the half-open trial"""
+        if self.state == 'open':
+            return time.monotonic() - self.opened_at >= SHORTENER_BREAKER_COOLDOWN
+        return self.state == 'closed' or not self.probing
+    
+    def allow(self) -> bool:
+        if self.state == 'closed':
+            return True
+        if self.state == 'open' and time.monotonic() - self.opened_at >= SHORTENER_BREAKER_COOLDOWN:
+            self.state = 'half-open'
+        if self.state == 'half-open' and not self.probing:
+            self.probing = True
+            return True
+        return False
+    
+    def record(self, ok: bool, seconds: float) -> None:
+        self.samples.append((ok, seconds))
+        self.probing = False
+        if ok:
+            self.consecutive_failures = 0
+            self.state = 'closed'
+            return
+        
+        self.consecutive_failures += 1
+        if (
+            self.state == 'half-open'
+            or self.consecutive_failures >= SHORTENER_BREAKER_FAILURES
+            or (len(self.samples) >= 10 and self.error_rate() >= SHORTENER_BREAKER_ERROR_RATE)
+        ):
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+    
+    def error_rate(self) -> float:
+        if not self.samples:
+            return 0.0
+        return sum(1 for ok, _ in self.samples if not ok) / len(self.samples)
+    
+    def p95(self):
+        latencies = sorted(seconds for ok, seconds in self.samples if ok)
+        if len(latencies) < 10:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    
+    def hedge_delay(self, timeout: float) -> float:
+        """How long to wait for this provider before also asking the next one"""
+        p95 = self.p95()
+        delay = SHORTENER_HEDGE_DEFAULT_DELAY if p95 is None else p95
+        return min(max(delay, SHORTENER_HEDGE_MIN_DELAY), timeout)
+    
+    def describe(self) -> str:
+        p95 = self.p95()
+        p95_text = f"{p95:.2f}s" if p95 is not None else "n/a"
+        return f"{self.state}, p95 {p95_text}, errors {self.error_rate():.0%} of {len(self.samples)}"
+
+# Token bucket spacing out calls to a provider
+class RateLimiter:
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return  # Unlimited
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# URL shortening provider on the shared async HTTP client
+class ShortenerProvider:
+    """Base provider: subclasses implement shorten(url) and raise ShortenerError on failure"""
+    name = "Provider"
+    cacheable = True  # Results go through short_link_cache
+    
+    def __init__(self, api_url: str, timeout: float, rate_limit: float = 0):
+        self.api_url = api_url
+        self.timeout = timeout
+        self.health = ProviderHealth()
+        self.rate_limiter = RateLimiter(rate_limit)
+    
+    async def shorten(self, url: str) -> str:
+        raise NotImplementedError
+
+# TinyURL: plain-text API
+class TinyURLProvider(ShortenerProvider):
+    name = "TinyURL"
+    
+    async def shorten(self, url: str) -> str:
+        response = await get_http_client().get(self.api_url, params={'url': url}, timeout=self.timeout)
+        short_url = response.text.strip()
+        if response.status_code != 200 or not short_url.startswith(('http://', 'https://')):
+            raise ShortenerError(f"TinyURL request failed with status {response.status_code}")
+        return short_url
+
+# VK: utils.getShortLink
+class VKProvider(ShortenerProvider):
+    name = "VK"
+    
+    def __init__(self, api_url: str, timeout: float, access_token: str, api_version: str, rate_limit: float = 0):
+        super().__init__(api_url, timeout, rate_limit)
+        self.access_token = access_token
+        self.api_version = api_version
+    
+    async def shorten(self, url: str) -> str:
+        if not self.access_token:
+            raise ShortenerError("VK access token is not configured")
+        
         params = {
-            'access_token': VK_ACCESS_TOKEN,
-            'v': VK_API_VERSION,
+            'access_token': self.access_token,
+            'v': self.api_version,
             'url': url
         }
+        response = await get_http_client().get(self.api_url, params=params, timeout=self.timeout)
+        if response.status_code != 200:
+            raise ShortenerError(f"VK API request failed with status {response.status_code}")
         
-        response = requests.get(VK_SHORTLINK_URL, params=params, timeout=10)
+        # Check if response contains the expected structure
+        data = response.json()
+        if 'response' in data and 'short_url' in data['response']:
+            return data['response']['short_url']
+        raise ShortenerError(f"VK API unexpected response format: {data.get('error', {}).get('error_msg', data)}")
+
+# Local shortener: the store is the service, so there is no round trip to fail or hedge
+class LocalProvider(ShortenerProvider):
+    name = "Local"
+    cacheable = False  # The store already hands out one code per URL
+    
+    def __init__(self, base_url: str, store):
+        super().__init__(base_url, timeout=1.0)
+        self.store = store
+    
+    async def shorten(self, url: str) -> str:
+        return f"{self.api_url.rstrip('/')}/{self.store.shorten(url)}"
+
+# Normalize a URL for cache lookups
+def normalize_url(url: str) -> str:
+    """Lowercase scheme and host, drop default ports, sort query parameters"""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme, netloc.rsplit(':', 1)[-1]) in (('http', '80'), ('https', '443')):
+        netloc = netloc.rsplit(':', 1)[0]
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or '/', query, parts.fragment))
+
+# Shortened URLs by provider, so repeated links skip the provider round trip
+class ShortLinkCache:
+    """In-memory LRU in front of a SQLite store; entries expire after a TTL and the store is size-bounded"""
+    
+    def __init__(self, path: str, ttl: int, max_entries: int, memory_entries: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()  # key -> (short_url, created_at)
+        self.connection = None
+        self.puts = 0
+    
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS short_links ("
+                "key TEXT PRIMARY KEY, short_url TEXT NOT NULL, created_at REAL, used_at REAL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS short_links_used_at ON short_links (used_at)")
+        return self.connection
+    
+    @staticmethod
+    def make_key(url: str, provider: str) -> str:
+        return f"{provider}:{normalize_url(url)}"
+    
+    def remember(self, key: str, short_url: str, created_at: float) -> None:
+        self.memory[key] = (short_url, created_at)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+    
+    def get(self, url: str, provider: str):
+        """Return the cached short URL, or None if missing or expired"""
+        key = self.make_key(url, provider)
+        now = time.time()
         
-        if response.status_code == 200:
-            data = response.json()
-            
-            # Check if response contains the expected structure
-            if 'response' in data and 'short_url' in data['response']:
-                return data['response']['short_url']
-            else:
-                print(f"VK API unexpected response format: {data}")
-                return None
-        else:
-            print(f"VK API request failed with status {response.status_code}")
+        cached = self.memory.get(key)
+        if cached and now - cached[1] < self.ttl:
+            self.memory.move_to_end(key)
+            metrics.increment('short_link_cache.memory_hits')
+            return cached[0]
+        
+        row = self.connect().execute(
+            "SELECT short_url, created_at FROM short_links WHERE key = ? AND created_at > ?", (key, now - self.ttl)
+        ).fetchone()
+        if row is None:
+            self.memory.pop(key, None)
+            metrics.increment('short_link_cache.misses')
             return None
-            
-    except Exception as e:
-        print(f"VK API error: {e}")
+        
+        with self.connection:
+            self.connection.execute("UPDATE short_links SET used_at = ? WHERE key = ?", (now, key))
+        self.remember(key, row[0], row[1])
+        metrics.increment('short_link_cache.disk_hits')
+        return row[0]
+    
+    def put(self, url: str, provider: str, short_url: str) -> None:
+        key = self.make_key(url, provider)
+        now = time.time()
+        self.remember(key, short_url, now)
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO short_links (key, short_url, created_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, short_url, now, now)
+            )
+        
+        self.puts += 1
+        if self.puts % 100 == 0:
+            self.evict()
+    
+    def evict(self) -> None:
+        """Drop expired entries, then the least recently used ones beyond max_entries"""
+        with self.connect() as connection:
+            connection.execute("DELETE FROM short_links WHERE created_at <= ?", (time.time() - self.ttl,))
+            connection.execute(
+                "DELETE FROM short_links WHERE key IN ("
+                "SELECT key FROM short_links ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+    
+    def format_stats(self) -> str:
+        counters = metrics.counters
+        hits = counters.get('short_link_cache.memory_hits', 0) + counters.get('short_link_cache.disk_hits', 0)
+        lookups = hits + counters.get('short_link_cache.misses', 0)
+        hit_rate = f"{hits / lookups:.0%}" if lookups else "n/a"
+        return f"Short link cache: {hit_rate} hit rate over {lookups} lookups, {len(self.memory)} in memory"
+
+short_link_cache = ShortLinkCache(
+    SHORT_LINK_CACHE_PATH, SHORT_LINK_CACHE_TTL, SHORT_LINK_CACHE_MAX_ENTRIES, SHORT_LINK_CACHE_MEMORY_ENTRIES
+)
+
+BASE62_DIGITS = {char: digit for digit, char in enumerate(BASE62_ALPHABET)}
+
+# Encode a row id as a short code
+def base62_encode(number: int) -> str:
+    code = ""
+    while True:
+        number, digit = divmod(number, 62)
+        code = BASE62_ALPHABET[digit] + code
+        if number == 0:
+            return code
+
+# Decode a short code back to a row id, or None if it isn't one
+def base62_decode(code: str):
+    if not code or len(code) > 11:  # 62**11 is past SQLite's largest rowid
         return None
+    number = 0
+    for char in code:
+        digit = BASE62_DIGITS.get(char)
+        if digit is None:
+            return None
+        number = number * 62 + digit
+    return number
+
+# Links of the built-in shortener
+class LocalLinkStore:
+    """URLs keyed by base62-encoded SQLite row ids, with an LRU of recently redirected ones
+
+    Codes never change once issued, so the LRU needs no invalidation, even when the bot and the
+    redirect server are separate processes sharing the file.
+    """
+    
+    def __init__(self, path: str, hot_entries: int):
+        self.path = path
+        self.hot_entries = hot_entries
+        self.hot = OrderedDict()  # row id -> url
+        self.connection = None
+    
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute("PRAGMA journal_mode=WAL")  # The redirect server reads while the bot writes
+            self.connection.execute("PRAGMA synchronous=NORMAL")  # No fsync per link; WAL checkpoints still sync
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS local_links ("
+                "id INTEGER PRIMARY KEY, url TEXT NOT NULL UNIQUE, created_at REAL)"
+            )
+        return self.connection
+    
+    def shorten(self, url: str) -> str:
+        """Return the code for url, creating it on first use"""
+        url = url.strip()
+        if not url.startswith(('http://', 'https://')) or re.search(r'[\s\x00-\x1f\x7f]', url):
+            raise ShortenerError("Only http(s) links without spaces can be shortened")
+        url = quote(url, safe="%:/?#[]@!$&'()*+,;=~")  # Location headers must be ASCII
+        
+        connection = self.connect()
+        row = connection.execute("SELECT id FROM local_links WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            with connection:
+                connection.execute(
+                    "INSERT OR IGNORE INTO local_links (url, created_at) VALUES (?, ?)", (url, time.time())
+                )
+            # Another process may have inserted the same URL first
+            row = connection.execute("SELECT id FROM local_links WHERE url = ?", (url,)).fetchone()
+        return base62_encode(row[0])
+    
+    def resolve(self, code: str):
+        """Return the URL behind code, or None"""
+        row_id = base62_decode(code)
+        if row_id is None:
+            return None
+        
+        url = self.hot.get(row_id)
+        if url is not None:
+            self.hot.move_to_end(row_id)
+            return url
+        
+        row = self.connect().execute("SELECT url FROM local_links WHERE id = ?", (row_id,)).fetchone()
+        if row is None:
+            return None
+        self.hot[row_id] = row[0]
+        while len(self.hot) > self.hot_entries:
+            self.hot.popitem(last=False)
+        return row[0]
+    
+    def close(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+local_link_store = LocalLinkStore(LOCAL_SHORTENER_PATH, LOCAL_SHORTENER_HOT_ENTRIES)
+
+# Minimal HTTP/1.1 server on asyncio streams; subclasses answer requests in handle_request
+class AsyncHTTPServer:
+    """Keep-alive aware; request bodies need a Content-Length of at most max_body bytes"""
+    REASONS = {
+        200: 'OK', 302: 'Found', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+        405: 'Method Not Allowed', 411: 'Length Required', 413: 'Payload Too Large',
+    }
+    max_body = 0
+    
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.server = None
+        self.connections = {}  # Writer -> handler task
+    
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]  # Port 0 picks a free one
+        return self
+    
+    async def close(self) -> None:
+        if self.server is None:
+            return
+        self.server.close()
+        handlers = list(self.connections.values())
+        for writer in list(self.connections):
+            writer.close()
+        if handlers:
+            await asyncio.wait(handlers, timeout=1)  # Handlers end on the EOF
+        await self.server.wait_closed()
+        self.server = None
+    
+    @classmethod
+    def response(cls, status: int, headers: dict = None, keep_alive: bool = True) -> bytes:
+        head = f"HTTP/1.1 {status} {cls.REASONS[status]}\r\nContent-Length: 0\r\n"
+        for name, value in (headers or {}).items():
+            head += f"{name}: {value}\r\n"
+        head += "Connection: keep-alive\r\n\r\n" if keep_alive else "Connection: close\r\n\r\n"
+        return head.encode('ascii')
+    
+    def handle_request(self, method: bytes, target: bytes, headers: dict, body: bytes) -> tuple:
+        """Return (status, response headers or None); headers are keyed by lowercase bytes names"""
+        raise NotImplementedError
+    
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                request_line, *header_lines = head[:-4].split(b'\r\n')
+                try:
+                    method, target, version = request_line.split(b' ')
+                    headers = {}
+                    for line in header_lines:
+                        name, _, value = line.partition(b':')
+                        headers[name.strip().lower()] = value.strip()
+                    length = int(headers.get(b'content-length', 0))
+                except ValueError:
+                    writer.write(self.response(400, keep_alive=False))
+                    break
+                if b'transfer-encoding' in headers:
+                    writer.write(self.response(411, keep_alive=False))
+                    break
+                if length > self.max_body:
+                    writer.write(self.response(413, keep_alive=False))
+                    break
+                body = await reader.readexactly(length) if length else b''
+                
+                keep_alive = version == b'HTTP/1.1' and headers.get(b'connection', b'').lower() != b'close'
+                status, response_headers = self.handle_request(method, target, headers, body)
+                writer.write(self.response(status, response_headers, keep_alive))
+                if not keep_alive:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass  # Client went away or sent an oversized header
+        finally:
+            self.connections.pop(writer, None)
+            writer.close()
+
+# Redirect /<code> to the stored URL
+class RedirectServer(AsyncHTTPServer):
+    """GET/HEAD of a known code gets a 302, anything else a 4xx"""
+    
+    def __init__(self, store: LocalLinkStore, host: str, port: int):
+        super().__init__(host, port)
+        self.store = store
+    
+    def handle_request(self, method: bytes, target: bytes, headers: dict, body: bytes) -> tuple:
+        if method not in (b'GET', b'HEAD'):
+            return 405, None
+        url = self.store.resolve(target.split(b'?', 1)[0].lstrip(b'/').decode('ascii', 'replace'))
+        metrics.increment('redirects.served' if url else 'redirects.not_found')
+        return (302, {'Location': url}) if url else (404, None)
+
+SHORTENERS = {
+    'tinyurl': TinyURLProvider(TINYURL_API_URL, TINYURL_TIMEOUT, TINYURL_RATE_LIMIT),
+    'vk': VKProvider(VK_SHORTLINK_URL, VK_TIMEOUT, VK_ACCESS_TOKEN, VK_API_VERSION, VK_RATE_LIMIT),
+}
+
+# Providers to try, in order, for each shortener a user or platform can pick
+SHORTENER_CHOICES = {
+    'tinyurl': ['tinyurl'],
+    'vk': ['vk', 'tinyurl'],  # Fallback to TinyURL if VK API fails
+}
+
+if LOCAL_SHORTENER_BASE_URL:
+    SHORTENERS['local'] = LocalProvider(LOCAL_SHORTENER_BASE_URL, local_link_store)
+    SHORTENER_CHOICES['local'] = ['local', 'tinyurl']
+
+# Call one provider, recording its health
+async def call_shortener(key: str, url: str) -> str:
+    provider = SHORTENERS[key]
+    await provider.rate_limiter.acquire()
+    started = time.perf_counter()
+    try:
+        short_url = await provider.shorten(url)
+    except (ShortenerError, httpx.HTTPError, ValueError) as e:
+        provider.health.record(False, time.perf_counter() - started)
+        print(f"{provider.name} shortener error: {e!r}")
+        metrics.increment(f"shortener.{key}.errors")
+        raise ShortenerError(f"{provider.name}: {e}")
+    except asyncio.CancelledError:
+        provider.health.probing = False  # A hedge won; this call says nothing about the provider
+        raise
+    
+    provider.health.record(True, time.perf_counter() - started)
+    metrics.observe(f"shortener.{key}", time.perf_counter() - started)
+    return short_url
+
+# Shorten a URL with the first provider that succeeds
+async def shorten_link(url: str, providers: list, hedge: bool = SHORTENER_HEDGING) -> tuple:
+    """Return (short_url, provider name) from the named SHORTENERS, in order of preference
+
+    Cached links are reused, providers with an open circuit are skipped, and with hedge the next
+    provider is also asked once the current one is slower than its recent p95.
+    """
+    started = time.perf_counter()
+    for key in providers:
+        if not SHORTENERS[key].cacheable:
+            break  # Asking this provider is as cheap as the cache
+        short_url = short_link_cache.get(url, key)
+        if short_url is not None:
+            metrics.observe("shorten_link", time.perf_counter() - started)
+            return short_url, SHORTENERS[key].name
+    
+    candidates = [key for key in providers if SHORTENERS[key].health.available()]
+    forced = not candidates
+    if forced:
+        # Everything is marked down; trying is still better than failing outright
+        metrics.increment('shortener.all_circuits_open')
+        candidates = list(providers)
+    
+    errors = []
+    pending = {}  # Task -> provider key
+    launched = 0
+    latest = None
+    
+    def launch_next() -> bool:
+        # Claim a half-open provider's trial call only when it is really made; False if none was started
+        nonlocal launched, latest
+        while launched < len(candidates):
+            key = candidates[launched]
+            launched += 1
+            if forced or SHORTENERS[key].health.allow():
+                latest = SHORTENERS[key]
+                pending[asyncio.create_task(call_shortener(key, url))] = key
+                return True
+        return False
+    
+    launch_next()
+    try:
+        while pending:
+            timeout = None
+            if hedge and launched < len(candidates):
+                timeout = latest.health.hedge_delay(latest.timeout)
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if launch_next():
+                    metrics.increment('shortener.hedged')
+                continue
+            
+            for task in done:
+                key = pending.pop(task)
+                try:
+                    short_url = task.result()
+                except ShortenerError as e:
+                    errors.append(str(e))
+                    continue
+                if SHORTENERS[key].cacheable:
+                    short_link_cache.put(url, key, short_url)
+                metrics.observe("shorten_link", time.perf_counter() - started)
+                return short_url, SHORTENERS[key].name
+            
+            # Fall back right away instead of waiting for the hedge delay
+            if not pending and launched < len(candidates):
+                launch_next()
+    finally:
+        for task in pending:
+            task.cancel()
+    
+    raise ShortenerError("; ".join(errors) or "No shortener is available right now")
+
+# Health summary of the shortening providers
+def format_shortener_health() -> str:
+    return "\n".join(f"{provider.name}: {provider.health.describe()}" for provider in SHORTENERS.values())
+
+# Time local shortening, then redirect throughput over keep-alive connections
+def benchmark_redirects(links: int = 1000, connections: int = 50, seconds: float = 5):
+    """Print shorten latency and redirects/sec; the clients share the server's event loop and CPU"""
+    return asyncio.run(run_redirect_benchmark(links, connections, seconds))
+
+async def run_redirect_benchmark(links: int, connections: int, seconds: float) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        store = LocalLinkStore(os.path.join(directory, 'bench_links.sqlite3'), LOCAL_SHORTENER_HOT_ENTRIES)
+        codes = []
+        write_times = []
+        for i in range(links):
+            started = time.perf_counter()
+            codes.append(store.shorten(f"https://example.com/landing?utm_source=bench&utm_campaign=c{i}"))
+            write_times.append(time.perf_counter() - started)
+        write_times.sort()
+        write_p50, write_p99 = write_times[len(write_times) // 2], write_times[int(len(write_times) * 0.99)]
+        print(f"Shorten: p50 {write_p50 * 1e6:.0f}us, p99 {write_p99 * 1e6:.0f}us over {links} new links")
+        
+        server = await RedirectServer(store, '127.0.0.1', 0).start()
+        latencies = []
+        deadline = time.perf_counter() + seconds
+        
+        async def client(index: int):
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+            while time.perf_counter() < deadline:
+                code = codes[index % len(codes)]
+                index += connections
+                started = time.perf_counter()
+                writer.write(f"GET /{code} HTTP/1.1\r\nHost: bench\r\n\r\n".encode('ascii'))
+                head = await reader.readuntil(b'\r\n\r\n')
+                if not head.startswith(b'HTTP/1.1 302'):
+                    raise RuntimeError(f"Unexpected response: {head[:40]!r}")
+                latencies.append(time.perf_counter() - started)
+            writer.close()
+            await writer.wait_closed()
+        
+        started = time.perf_counter()
+        await asyncio.gather(*(client(i) for i in range(connections)))
+        elapsed = time.perf_counter() - started
+        await server.close()
+        store.close()
+    
+    latencies.sort()
+    results = {
+        'shorten_p50': write_p50,
+        'shorten_p99': write_p99,
+        'redirects_per_sec': len(latencies) / elapsed,
+        'redirect_p50': latencies[len(latencies) // 2],
+        'redirect_p99': latencies[int(len(latencies) * 0.99)],
+    }
+    print(
+        f"Redirects: {results['redirects_per_sec']:.0f}/sec over {connections} connections, "
+        f"p50 {results['redirect_p50'] * 1e3:.2f}ms, p99 {results['redirect_p99'] * 1e3:.2f}ms"
+    )
+    return results
 
 # New function to generate final UTM URL
 async def generate_utm_final_url(update: Update, context: ContextTypes.DEFAULT_TYPE, campaign: str) -> int:
@@ -385,7 +1417,7 @@ async def generate_utm_final_url(update: Update, context: ContextTypes.DEFAULT_T
         utm_url = build_utm_url(base_url, utm_source, utm_campaign)
         
         # Shorten the UTM URL
-        short_url = pyshorteners.Shortener().tinyurl.short(utm_url)
+        short_url, _ = await shorten_link(utm_url, ['tinyurl'])
         
         # Create response message
         response_text = "🔗 UTM Tracking URL Created!\n\n"
@@ -464,92 +1496,774 @@ async def handle_utm_campaign(update: Update, context: ContextTypes.DEFAULT_TYPE
     return await proceed_to_platform_choice(update, context)
 
 # Build UTM URL with parameters
-def build_utm_url(base_url: str, utm_source: str, utm_campaign: str) -> str:
+def build_utm_url(base_url: str, utm_source: str, utm_campaign: str, utm_medium: str = 'smm') -> str:
     """Build URL with UTM parameters"""
-    from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
-    
+    return utm_url_builder(base_url)(utm_source, utm_campaign, utm_medium)
+
+# Parse a base URL once for building many UTM variants of it
+def utm_url_builder(base_url: str):
+    """Return build(utm_source, utm_campaign, utm_medium) -> URL"""
     # Parse the URL
     parsed = urlparse(base_url)
     query_dict = parse_qs(parsed.query)
     
-    # Add UTM parameters (convert to single values for urlencode)
-    utm_params = {
-        'utm_source': utm_source,
-        'utm_campaign': utm_campaign,
-        'utm_medium': 'smm'  # Default medium
-    }
-    
-    # Add UTM parameters to existing query parameters
-    for key, value in utm_params.items():
-        query_dict[key] = [value]  # parse_qs returns lists, so we need lists
-    
-    # Convert back to query string
-    new_query = urlencode(query_dict, doseq=True)
+    def build(utm_source: str, utm_campaign: str, utm_medium: str = 'smm') -> str:
+        # Add UTM parameters to existing query parameters (parse_qs returns lists, so we need lists)
+        params = dict(query_dict)
+        params['utm_source'] = [utm_source]
+        params['utm_campaign'] = [utm_campaign]
+        params['utm_medium'] = [utm_medium]
+        
+        # Convert back to query string and rebuild URL
+        return urlunparse(parsed._replace(query=urlencode(params, doseq=True)))
     
-    # Rebuild URL
-    new_parsed = parsed._replace(query=new_query)
-    return urlunparse(new_parsed)
-
-# Handle video processing
-async def process_video(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    video = update.message.video or update.message.document
-    if not video:
-        await update.message.reply_text("Please send a valid video file.")
-        return VIDEO
+    return build
 
-    # Download video
-    file = await video.get_file()
-    input_path = "input_video.mp4"
-    output_path = "round_video.mp4"
-    await file.download_to_drive(input_path)
+inline_latest_queries = {}  # user id -> newest inline query id
+inline_shortenings = {}  # (providers, url) -> task, shared by overlapping inline queries
 
-    # Crop and resize using moviepy
-    try:
-        clip = VideoFileClip(input_path)
-        duration = min(clip.duration, 60)
-        clip = cast(VideoFileClip, clip.subclipped(0, duration))
-        size = min(clip.w, clip.h)
-        crop_effect = Crop(x_center=clip.w / 2, y_center=clip.h / 2, width=size, height=size)
-        clip = clip.with_effects([crop_effect])
-
-        target_size = 512 if size > 512 else 240
-        clip = clip.resized((target_size, target_size))
-        
-        # Write video with optimized settings for video notes
-        clip.write_videofile(
-            output_path, 
-            codec="libx264", 
-            audio_codec="aac",
-            bitrate="500k",  # Lower bitrate for smaller file size
-            fps=24           # Standard fps for video notes
-        )
-        clip.close()
+# Shorten a link for inline mode, joining a call already in flight for it
+def inline_shortening_task(url: str, providers: list) -> asyncio.Task:
+    """The task outlives the query that started it, so a slow provider still fills the cache for the next one"""
+    key = (tuple(providers), url)
+    task = inline_shortenings.get(key)
+    if task is None:
+        task = asyncio.create_task(shorten_link(url, providers))
+        inline_shortenings[key] = task
         
-    except Exception as e:
-        await update.message.reply_text(f"Processing failed: {e}")
-        context.user_data['state'] = CHOOSING
-        return CHOOSING
+        def forget(done: asyncio.Task):
+            inline_shortenings.pop(key, None)
+            if not done.cancelled():
+                done.exception()  # Failures are reported in the answer, not as unretrieved exceptions
+        
+        task.add_done_callback(forget)
+    return task
 
-    # Send as round video (video note)
-    try:
-        with open(output_path, 'rb') as video_file:
-            await update.message.reply_video_note(
-                video_file,
-                duration=int(duration),
-                length=target_size
+# Answer @bot <url> [campaign] with the short link and UTM variants
+async def inline_shorten(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.inline_query
+    received = time.perf_counter()
+    user_id = query.from_user.id
+    
+    # Debounce: Telegram sends a query per keystroke, only the last one is worth shortening
+    inline_latest_queries[user_id] = query.id
+    await asyncio.sleep(INLINE_DEBOUNCE_SECONDS)
+    if inline_latest_queries.get(user_id) != query.id:
+        metrics.increment('inline.debounced')
+        return
+    inline_latest_queries.pop(user_id, None)
+    
+    parts = query.query.split()
+    url = parts[0].rstrip('.)') if parts else ''
+    if not URL_PATTERN.fullmatch(url) or '.' not in urlsplit(url).netloc:
+        try:
+            await query.answer(
+                [], cache_time=INLINE_CACHE_TIME,
+                button=InlineQueryResultsButton("Type a link to shorten it", start_parameter="inline")
             )
+        except Exception as e:
+            print(f"Inline answer failed: {e}")
+        return
+    
+    # Campaign from the query, or the last path segment like the UTM dialog suggests
+    campaign = parts[1] if len(parts) > 1 else urlsplit(url).path.strip('/').split('/')[-1]
+    variants = [("✂️ Short link", url)]
+    if campaign:
+        build = utm_url_builder(url)
+        variants += [(f"📊 UTM: {source} / {campaign}", build(source, campaign)) for source in INLINE_UTM_SOURCES]
+    
+    providers = user_shortener(context)
+    tasks = [inline_shortening_task(long_url, providers) for _, long_url in variants]
+    await asyncio.wait(tasks, timeout=max(INLINE_ANSWER_BUDGET - (time.perf_counter() - received), 0))
+    
+    # Links not shortened within the budget go out in full, with a short cache time
+    results = []
+    complete = True
+    for (title, long_url), task in zip(variants, tasks):
+        if task.done() and task.exception() is None:
+            short_url, provider_name = task.result()
+            description = f"{provider_name}: {long_url}"
+        else:
+            complete = False
+            short_url = long_url
+            description = "Still shortening, sends the full link" if not task.done() else "Shortening failed, sends the full link"
+        results.append(InlineQueryResultArticle(
+            id=hashlib.md5(long_url.encode('utf-8')).hexdigest(),
+            title=f"{title}: {short_url}",
+            description=description,
+            input_message_content=InputTextMessageContent(short_url),
+        ))
+    
+    try:
+        await query.answer(
+            results, cache_time=INLINE_CACHE_TIME if complete else INLINE_PENDING_CACHE_TIME,
+            is_personal=True  # Users can pick different shorteners
+        )
     except Exception as e:
-        await update.message.reply_text(f"Failed to send video: {e}")
-
-    # Clean up files
-    if os.path.exists(input_path):
-        os.remove(input_path)
-    if os.path.exists(output_path):
-        os.remove(output_path)
+        print(f"Inline answer failed: {e}")
+    
+    metrics.increment('inline.answered' if complete else 'inline.answered_pending')
+    metrics.observe('inline.answer', time.perf_counter() - received)
 
-    await update.message.reply_text("Video note ready! Forward it to your channel.", reply_markup=markup)
-    context.user_data['state'] = CHOOSING
-    return CHOOSING
+class WorkspaceQuotaError(Exception):
+    """Raised when a job would push the workspaces over WORKSPACE_QUOTA_MB"""
+
+# Per-job scratch directories, on RAM-backed storage when available
+class JobWorkspaces:
+    """Create, account for and remove isolated job directories under a shared size quota"""
+    
+    def __init__(self, root: str = None, quota_bytes: int = WORKSPACE_QUOTA_MB * 1024 * 1024):
+        self.root = root or self.default_root()
+        self.quota_bytes = quota_bytes
+        self.reserved = {}
+        self.last_used = {}  # Workspace -> monotonic time of its last reservation or job
+        self.busy = {}  # Workspace -> jobs running in it
+    
+    @staticmethod
+    def default_root() -> str:
+        # Prefer tmpfs so intermediate files never touch the dyno's slow disk
+        if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+            return os.path.join('/dev/shm', 'smmbot')
+        return os.path.join(tempfile.gettempdir(), 'smmbot')
+    
+    def create(self, prefix: str = 'job') -> str:
+        os.makedirs(self.root, exist_ok=True)
+        workspace = tempfile.mkdtemp(prefix=f"{prefix}_", dir=self.root)
+        self.reserved[workspace] = 0
+        self.last_used[workspace] = time.monotonic()
+        return workspace
+    
+    def reserve(self, workspace: str, nbytes: int) -> None:
+        """Account nbytes to the workspace, raising WorkspaceQuotaError if the quota would be exceeded"""
+        if sum(self.reserved.values()) + nbytes > self.quota_bytes:
+            raise WorkspaceQuotaError(f"Workspace quota of {self.quota_bytes} bytes exceeded")
+        self.reserved[workspace] = self.reserved.get(workspace, 0) + nbytes
+        self.last_used[workspace] = time.monotonic()
+    
+    @contextlib.contextmanager
+    def in_use(self, workspace: str):
+        """Keep the workspace from expiring while a job runs in it"""
+        self.busy[workspace] = self.busy.get(workspace, 0) + 1
+        try:
+            yield
+        finally:
+            self.busy[workspace] -= 1
+            if not self.busy[workspace]:
+                del self.busy[workspace]
+            if workspace in self.reserved:
+                self.last_used[workspace] = time.monotonic()
+    
+    def expire(self, idle_seconds: float) -> int:
+        """Release workspaces untouched for idle_seconds, e.g. a cover whose audio never came; returns the count"""
+        cutoff = time.monotonic() - idle_seconds
+        expired = [
+            workspace for workspace, used in self.last_used.items()
+            if used < cutoff and workspace not in self.busy
+        ]
+        for workspace in expired:
+            self.release(workspace)
+        return len(expired)
+    
+    def release(self, workspace: str) -> None:
+        self.reserved.pop(workspace, None)
+        self.last_used.pop(workspace, None)
+        if os.path.dirname(os.path.abspath(workspace)) == os.path.abspath(self.root):
+            shutil.rmtree(workspace, ignore_errors=True)
+    
+    def purge(self, keep_seconds: float = 0) -> None:
+        """Remove workspaces left behind by a previous process, except ones modified in the last keep_seconds"""
+        for name in os.listdir(self.root) if os.path.isdir(self.root) else []:
+            path = os.path.join(self.root, name)
+            if path not in self.reserved and time.time() - os.path.getmtime(path) >= keep_seconds:
+                shutil.rmtree(path, ignore_errors=True)
+
+workspaces = JobWorkspaces(WORKSPACE_ROOT)
+
+# Finished video notes keyed by their inputs, so identical requests are answered by file_id
+class RenderCache:
+    """SQLite map from (input file_unique_ids, render parameters) to the sent video note's file_id"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = None
+    
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS render_cache ("
+                "key TEXT PRIMARY KEY, file_id TEXT NOT NULL, duration REAL, length INTEGER, created_at REAL)"
+            )
+        return self.connection
+    
+    @staticmethod
+    def make_key(kind: str, unique_ids: list, params: dict) -> str:
+        payload = json.dumps({'kind': kind, 'inputs': unique_ids, 'params': params}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+    
+    def get(self, key: str):
+        """Return {'file_id', 'duration', 'length'} for a cached render, or None"""
+        row = self.connect().execute(
+            "SELECT file_id, duration, length FROM render_cache WHERE key = ?", (key,)
+        ).fetchone()
+        metrics.increment('render_cache.hits' if row else 'render_cache.misses')
+        if row is None:
+            return None
+        return {'file_id': row[0], 'duration': row[1], 'length': row[2]}
+    
+    def put(self, key: str, file_id: str, duration: float, length: int) -> None:
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO render_cache (key, file_id, duration, length, created_at) VALUES (?, ?, ?, ?, ?)",
+                (key, file_id, duration, length, time.time())
+            )
+    
+    def forget(self, key: str) -> None:
+        with self.connect() as connection:
+            connection.execute("DELETE FROM render_cache WHERE key = ?", (key,))
+
+render_cache = RenderCache(RENDER_CACHE_PATH)
+
+# Answer a request from the render cache by resending the stored file_id
+async def send_cached_video_note(update: Update, cache_key: str) -> bool:
+    """Return True if a cached video note was sent"""
+    cached = render_cache.get(cache_key)
+    if cached is None:
+        return False
+    
+    try:
+        await update.message.reply_video_note(cached['file_id'], duration=int(cached['duration']), length=cached['length'])
+    except Exception as e:
+        # The file_id is no longer usable; render again
+        print(f"Render cache entry failed to send: {e}")
+        render_cache.forget(cache_key)
+        return False
+    return True
+
+# Render parameters that change the output, part of every render cache key
+def render_cache_params(kind: str, profile: str = None) -> dict:
+    """profile is the encoding profile the user asked for; None for outputs that are never re-encoded"""
+    params = {'version': RENDER_CACHE_VERSION}
+    if profile is not None:
+        params['profile'] = profile
+    if kind == 'vinyl':
+        params.update({
+            'target_size': 512, 'fps': VINYL_FPS, 'strength': VINYL_STRENGTH,
+            'degrees_per_second': VINYL_DEGREES_PER_SECOND,
+        })
+    else:
+        params.update({'fps': VIDEO_NOTE_FPS})
+    return params
+
+# Run the bundled ffmpeg binary
+def run_ffmpeg(args: list, on_progress=None, duration: float = None) -> None:
+    """Run ffmpeg with the given arguments, raising RuntimeError on failure
+
+    on_progress(done_seconds, duration) is called as ffmpeg reports the output time encoded so far.
+    """
+    if on_progress is None or not duration:
+        result = subprocess.run(
+            [FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y', *args],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        returncode, stderr = result.returncode, result.stderr
+    else:
+        with tempfile.TemporaryFile() as stderr_file:
+            process = subprocess.Popen(
+                [FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y', '-progress', 'pipe:1', '-nostats', *args],
+                stdout=subprocess.PIPE, stderr=stderr_file
+            )
+            for line in process.stdout:
+                if line.startswith(b'out_time_us='):
+                    try:
+                        done = int(line[len(b'out_time_us='):]) / 1_000_000
+                    except ValueError:
+                        continue  # N/A before the first frame
+                    on_progress(min(max(done, 0), duration), duration)
+            returncode = process.wait()
+            stderr_file.seek(0)
+            stderr = stderr_file.read()
+    
+    if returncode != 0:
+        error = stderr.decode(errors='replace').strip().splitlines()
+        raise RuntimeError(f"ffmpeg failed: {error[-1] if error else returncode}")
+
+# Forward moviepy's frame progress to a render progress callback
+class RenderProgressLogger(proglog.ProgressBarLogger):
+    def __init__(self, on_progress, duration: float):
+        super().__init__()
+        self.on_progress = on_progress
+        self.duration = duration
+    
+    def bars_callback(self, bar, attr, value, old_value=None):
+        if bar == 'frame_index' and attr == 'index' and self.bars[bar].get('total'):
+            done = min(value / self.bars[bar]['total'], 1) * self.duration
+            self.on_progress(done, self.duration)
+
+# Translate an encoding profile into x264 options for a clip of the given duration
+def x264_options(profile_name: str, duration: float) -> tuple:
+    """Return (preset, ffmpeg_params) for the named profile"""
+    profile = ENCODING_PROFILES.get(profile_name, ENCODING_PROFILES['balanced'])
+    
+    if 'crf' in profile:
+        maxrate_kbps = int(profile['maxrate'].rstrip('k'))
+        params = ['-crf', str(profile['crf'])]
+    else:
+        # Spread the size budget over the clip, never above Telegram's upload limit
+        target_mb = min(ENCODING_TARGET_MB, TELEGRAM_UPLOAD_LIMIT_MB)
+        total_kbps = target_mb * 8 * 1024 / max(duration, 1)
+        maxrate_kbps = int(min(max(total_kbps - VIDEO_NOTE_AUDIO_KBPS, 100), ENCODING_MAX_KBPS))
+        params = ['-b:v', f"{maxrate_kbps}k"]
+    
+    params += ['-maxrate', f"{maxrate_kbps}k", '-bufsize', f"{maxrate_kbps * 2}k"]
+    return profile['preset'], params
+
+# Parse the input banner ffmpeg prints for a media file
+def parse_ffmpeg_banner(banner: str) -> dict:
+    """Extract duration and first video/audio stream details from `ffmpeg -i` output"""
+    info = {
+        'duration': None, 'video_codec': None, 'width': None, 'height': None,
+        'pix_fmt': None, 'audio_codec': None, 'rotation': 0,
+    }
+    
+    match = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', banner)
+    if match:
+        hours, minutes, seconds = match.groups()
+        info['duration'] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    
+    for line in banner.splitlines():
+        if 'rotation of' in line and not info['rotation']:
+            # Display matrix side data of a phone video shot in portrait
+            match = re.search(r'rotation of (-?\d+(?:\.\d+)?)', line)
+            info['rotation'] = float(match.group(1)) if match else 0
+        if 'Stream #' not in line:
+            continue
+        if 'Video:' in line and info['video_codec'] is None:
+            match = re.search(r'Video: (\w+)', line)
+            info['video_codec'] = match.group(1) if match else None
+            match = re.search(r'\), (\w+)[(,]|Video: \w+, (\w+)[(,]', line)
+            info['pix_fmt'] = next((group for group in match.groups() if group), None) if match else None
+            match = re.search(r', (\d{2,5})x(\d{2,5})', line)
+            if match:
+                info['width'], info['height'] = int(match.group(1)), int(match.group(2))
+        elif 'Audio:' in line and info['audio_codec'] is None:
+            match = re.search(r'Audio: (\w+)', line)
+            info['audio_codec'] = match.group(1) if match else None
+    
+    return info
+
+# Wait for an ffmpeg subprocess, killing it if the job is cancelled
+async def communicate_or_kill(process) -> bytes:
+    try:
+        _, stderr = await process.communicate()
+    except BaseException:
+        process.kill()
+        await process.wait()
+        raise
+    return stderr
+
+# Probe a media file with the bundled ffmpeg (no decoding)
+async def probe_media(path: str) -> dict:
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_BINARY, '-hide_banner', '-i', path,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    stderr = await communicate_or_kill(process)
+    return parse_ffmpeg_banner(stderr.decode(errors='replace'))
+
+# Run the bundled ffmpeg binary without blocking the event loop
+async def run_ffmpeg_async(args: list) -> None:
+    """Async counterpart of run_ffmpeg"""
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y', *args,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    stderr = await communicate_or_kill(process)
+    if process.returncode != 0:
+        error = stderr.decode(errors='replace').strip().splitlines()
+        raise RuntimeError(f"ffmpeg failed: {error[-1] if error else process.returncode}")
+
+# Ingest vinyl audio: decode only the first minute and produce the AAC the final mux needs
+async def ingest_vinyl_audio(source_path: str, output_path: str) -> dict:
+    """Trim the source to 60 s into an AAC .m4a, stream-copying when it is already AAC"""
+    started = time.perf_counter()
+    info = await probe_media(source_path)
+    probed = time.perf_counter()
+    
+    if info['audio_codec'] is None:
+        raise ValueError("No audio stream found")
+    
+    copy = info['audio_codec'] == 'aac'
+    await run_ffmpeg_async([
+        '-i', source_path,
+        '-t', '60', '-vn', '-map', '0:a:0',
+        *(['-c:a', 'copy'] if copy else ['-c:a', 'aac', '-b:a', VINYL_AUDIO_BITRATE]),
+        output_path
+    ])
+    finished = time.perf_counter()
+    
+    report = {
+        'source_codec': info['audio_codec'],
+        'copied': copy,
+        'probe_seconds': probed - started,
+        'transcode_seconds': finished - probed,
+    }
+    print(
+        f"Audio ingest: {info['audio_codec']} -> {'copy' if copy else 'aac'}, "
+        f"probe {report['probe_seconds']:.2f}s, transcode {report['transcode_seconds']:.2f}s"
+    )
+    return report
+
+# Decide how much work an uploaded video needs to become a video note
+def plan_video_note(info: dict) -> str:
+    """Return 'remux' (already valid), 'cut' (valid but too long) or 'render'"""
+    valid_streams = (
+        info['video_codec'] == 'h264'
+        and info['pix_fmt'] == 'yuv420p'
+        and info['audio_codec'] in (None, 'aac')
+        and not info['rotation']
+    )
+    valid_frame = (
+        info['width'] is not None
+        and info['width'] == info['height']
+        and info['width'] <= VIDEO_NOTE_MAX_LENGTH
+    )
+    if not (valid_streams and valid_frame and info['duration']):
+        return 'render'
+    return 'remux' if info['duration'] <= 60 else 'cut'
+
+# Copy the streams of an already valid video note, trimming to a minute if needed
+async def remux_video_note(input_path: str, output_path: str) -> None:
+    await run_ffmpeg_async([
+        '-i', input_path,
+        '-t', '60',
+        '-map', '0:v:0', '-map', '0:a:0?',
+        '-c', 'copy', '-movflags', '+faststart',
+        output_path
+    ])
+
+# Shared HTTP client with a keep-alive connection pool
+_http_client = None
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS),
+            follow_redirects=True
+        )
+    return _http_client
+
+# Whether an upload can be piped straight into ffmpeg instead of staged to disk
+def can_stream_ingest(file, file_size: int, extension: str) -> bool:
+    return (
+        STREAM_INGEST_MAX_MB > 0
+        and (file_size or 0) <= STREAM_INGEST_MAX_MB * 1024 * 1024
+        and extension in STREAMABLE_AUDIO_EXTENSIONS
+        and file.file_path.startswith(('http://', 'https://'))
+    )
+
+# Ingest vinyl audio while it downloads, without staging the source file
+async def stream_ingest_vinyl_audio(file, output_path: str, copy: bool = False) -> dict:
+    """Pipe the download into ffmpeg; the transfer stops as soon as the first minute is encoded"""
+    started = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y',
+        '-i', 'pipe:0',
+        '-t', '60', '-vn', '-map', '0:a:0',
+        *(['-c:a', 'copy'] if copy else ['-c:a', 'aac', '-b:a', VINYL_AUDIO_BITRATE]),
+        output_path,
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    
+    received = 0
+    try:
+        async with get_http_client().stream('GET', file.file_path, timeout=STREAM_INGEST_TIMEOUT) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(STREAM_INGEST_CHUNK):
+                received += len(chunk)
+                try:
+                    process.stdin.write(chunk)
+                    await process.stdin.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    break  # ffmpeg already has the minute it needs
+        process.stdin.close()
+        _, stderr = await process.communicate()
+    except BaseException:
+        process.kill()
+        await process.wait()
+        raise
+    
+    if process.returncode != 0:
+        error = stderr.decode(errors='replace').strip().splitlines()
+        raise RuntimeError(f"ffmpeg failed: {error[-1] if error else process.returncode}")
+    
+    report = {
+        'copied': copy,
+        'received_bytes': received,
+        'stream_seconds': time.perf_counter() - started,
+    }
+    print(f"Audio stream ingest: {received} bytes received, done in {report['stream_seconds']:.2f}s")
+    return report
+
+# Render a square video note from an uploaded video
+def render_video_note(input_path: str, output_path: str, backend: str = RENDER_BACKEND,
+                      profile: str = ENCODING_PROFILE, preview: bool = False,
+                      max_size: int = None, max_duration: float = None, on_progress=None):
+    """Crop, resize and trim the video; returns (duration, target_size)
+
+    preview renders a short, small draft of the same crop. max_size and max_duration cap the output
+    further (used by render deadlines); on_progress(done_seconds, duration) reports encoding progress.
+    """
+    max_duration = min(PREVIEW_SECONDS if preview else 60, max_duration or 60)
+    
+    if backend == 'ffmpeg':
+        infos = ffmpeg_parse_infos(input_path)
+        duration = min(infos['duration'], max_duration)
+        width, height = infos['video_size']
+        size = min(width, height)
+        target_size = PREVIEW_SIZE if preview else (512 if size > 512 else 240)
+        target_size = min(target_size, max_size or target_size)
+        preset, x264_params = x264_options(profile, duration)
+        
+        run_ffmpeg([
+            '-i', input_path,
+            '-t', f"{duration:.3f}",
+            '-vf', f"crop={size}:{size},scale={target_size}:{target_size},fps={VIDEO_NOTE_FPS}",
+            '-map', '0:v:0', '-map', '0:a:0?',
+            '-c:v', 'libx264', '-preset', preset, *x264_params, '-pix_fmt', 'yuv420p',
+            '-c:a', 'aac', '-b:a', f"{VIDEO_NOTE_AUDIO_KBPS}k",
+            output_path
+        ], on_progress, duration)
+        return duration, target_size
+    
+    # Crop and resize using moviepy
+    clip = VideoFileClip(input_path)
+    duration = min(clip.duration, max_duration)
+    clip = cast(VideoFileClip, clip.subclipped(0, duration))
+    size = min(clip.w, clip.h)
+    crop_effect = Crop(x_center=clip.w / 2, y_center=clip.h / 2, width=size, height=size)
+    clip = clip.with_effects([crop_effect])
+
+    target_size = PREVIEW_SIZE if preview else (512 if size > 512 else 240)
+    target_size = min(target_size, max_size or target_size)
+    clip = clip.resized((target_size, target_size))
+    
+    # Write video with the encoding profile's settings
+    preset, x264_params = x264_options(profile, duration)
+    clip.write_videofile(
+        output_path, 
+        codec="libx264", 
+        audio_codec="aac",
+        audio_bitrate=f"{VIDEO_NOTE_AUDIO_KBPS}k",
+        preset=preset,
+        ffmpeg_params=x264_params,
+        temp_audiofile_path=os.path.dirname(output_path),  # Keep temp audio in the job workspace
+        logger=RenderProgressLogger(on_progress, duration) if on_progress else 'bar',
+        fps=VIDEO_NOTE_FPS           # Standard fps for video notes
+    )
+    clip.close()
+    return duration, target_size
+
+# Handle video processing
+async def process_video(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    video = update.message.video or update.message.document
+    if not video:
+        await update.message.reply_text("Please send a valid video file.")
+        return VIDEO
+
+    # Same source video already remuxed, or rendered in this user's profile: resend the finished note
+    profile = context.user_data.get('encoding_profile', ENCODING_PROFILE)
+    remux_key = RenderCache.make_key('video_note', [video.file_unique_id], render_cache_params('video_note'))
+    cache_key = RenderCache.make_key('video_note', [video.file_unique_id], render_cache_params('video_note', profile))
+    for key in (remux_key, cache_key):
+        if await send_cached_video_note(update, key):
+            await update.message.reply_text("Video note ready! Forward it to your channel.", reply_markup=markup)
+            context.user_data['state'] = CHOOSING
+            return CHOOSING
+
+    release_video_workspace(context)
+    render_scheduler.track(update.effective_user.id)
+    processing_msg = None
+    try:
+        workspace = workspaces.create('video')
+        input_path = os.path.join(workspace, "input_video.mp4")
+        output_path = os.path.join(workspace, "round_video.mp4")
+        context.user_data['video_workspace'] = workspace
+        context.user_data['video_input_path'] = input_path
+        context.user_data['video_unique_id'] = video.file_unique_id
+        processing_msg = await update.message.reply_text("📷 Processing video... This may take a moment!")
+
+        # Stage 1: download video
+        workspaces.reserve(workspace, (video.file_size or 0) + WORKSPACE_OUTPUT_ALLOWANCE)
+        file = await video.get_file()
+        await file.download_to_drive(input_path)
+
+        # Stage 2: probe, so unreadable uploads fail before taking a render slot
+        info = await probe_media(input_path)
+        if info['video_codec'] is None or not info['duration']:
+            await update.message.reply_text("Processing failed: no readable video stream found.", reply_markup=markup)
+            context.user_data['state'] = CHOOSING
+            return CHOOSING
+
+        # Stage 3a: square H.264/AAC uploads only need their streams copied
+        plan = plan_video_note(info)
+        if plan != 'render':
+            try:
+                await remux_video_note(input_path, output_path)
+            except RuntimeError as e:
+                print(f"Video note remux failed, rendering instead: {e}")
+            else:
+                metrics.increment(f"video_note.{plan}")
+                result = {'duration': min(info['duration'], 60), 'target_size': info['width']}
+                return await send_video_note(update, context, output_path, result, remux_key)
+
+        # Stage 3b: let the user check the crop on a quick draft before the full render
+        if PREVIEW_ENABLED:
+            job = build_video_note_job(context, preview=True)
+            if await send_preview(update, job, processing_msg):
+                processing_msg = None
+                context.user_data['state'] = VIDEO_PREVIEW
+                return VIDEO_PREVIEW
+
+        return await render_full_video_note(update, context, processing_msg)
+
+    except WorkspaceQuotaError:
+        await update.message.reply_text("⚠️ The server is busy with other videos right now. Please try again in a minute.", reply_markup=markup)
+        context.user_data['state'] = CHOOSING
+        return CHOOSING
+
+    except (RenderCancelledError, asyncio.CancelledError):
+        # /cancel or /stop already replied and freed the render slot
+        return context.user_data.get('state', CHOOSING)
+
+    finally:
+        # Clean up files (kept while a preview is awaiting confirmation) and the progress message
+        if context.user_data.get('state') != VIDEO_PREVIEW:
+            release_video_workspace(context)
+        if processing_msg:
+            try:
+                await processing_msg.delete()
+            except:
+                pass  # Ignore if message can't be deleted
+
+# Describe the user's video note render as a job descriptor
+def build_video_note_job(context: ContextTypes.DEFAULT_TYPE, preview: bool = False) -> dict:
+    workspace = context.user_data['video_workspace']
+    return {
+        'kind': 'video_note',
+        'input_path': context.user_data['video_input_path'],
+        'output_path': os.path.join(workspace, "preview_video.mp4" if preview else "round_video.mp4"),
+        'backend': context.user_data.get('render_backend', RENDER_BACKEND),
+        'profile': context.user_data.get('encoding_profile', ENCODING_PROFILE),
+        'preview': preview,
+    }
+
+# Crop and resize the downloaded video in a render worker, then upload it
+async def render_full_video_note(update: Update, context: ContextTypes.DEFAULT_TYPE, processing_msg=None) -> int:
+    job = build_video_note_job(context)
+    try:
+        result = await render_scheduler.run(job, update.effective_user.id, queue_position_notifier(processing_msg))
+    except RenderCancelledError:
+        raise
+    except Exception as e:
+        await update.effective_message.reply_text(f"Processing failed: {e}", reply_markup=markup)
+        context.user_data['state'] = CHOOSING
+        return CHOOSING
+
+    # Stage 4: upload, cached under the profile actually asked for (it may have changed since the preview)
+    metrics.increment("video_note.render")
+    cache_key = RenderCache.make_key(
+        'video_note', [context.user_data['video_unique_id']], render_cache_params('video_note', job['profile'])
+    )
+    return await send_video_note(update, context, job['output_path'], result, cache_key)
+
+# Render a draft of the job and offer to render it in full
+async def send_preview(update: Update, job: dict, processing_msg=None) -> bool:
+    """Return True once the preview is shown with confirm/redo buttons"""
+    try:
+        result = await render_scheduler.run(job, update.effective_user.id, queue_position_notifier(processing_msg))
+        with open(job['output_path'], 'rb') as preview_file:
+            await update.effective_message.reply_video_note(
+                preview_file,
+                duration=int(result['duration']),
+                length=result['target_size'],
+                reply_markup=preview_markup
+            )
+        os.remove(job['output_path'])
+    except RenderCancelledError:
+        raise
+    except Exception as e:
+        # No preview is better than no result: go straight to the full render
+        print(f"Preview failed: {e}")
+        return False
+    
+    metrics.increment(f"preview.{job['kind']}")
+    if processing_msg:
+        try:
+            await processing_msg.delete()
+        except:
+            pass  # Ignore if message can't be deleted
+    return True
+
+# Handle the confirm/redo buttons under a video note preview
+async def handle_video_preview(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    try:
+        await query.edit_message_reply_markup(reply_markup=None)
+    except Exception:
+        pass  # Buttons already removed
+    
+    drop_lost_workspaces(context.user_data)
+    if query.data == 'preview:redo' or 'video_input_path' not in context.user_data:
+        metrics.increment('preview.video_note.redo')
+        release_video_workspace(context)
+        await query.message.reply_text("Send a video (max 50MB, square, up to 1 minute):")
+        context.user_data['state'] = VIDEO
+        return VIDEO
+    
+    render_scheduler.track(update.effective_user.id)
+    processing_msg = await query.message.reply_text("📷 Rendering the full video note...")
+    try:
+        return await render_full_video_note(update, context, processing_msg)
+    except (RenderCancelledError, asyncio.CancelledError):
+        return context.user_data.get('state', CHOOSING)
+    finally:
+        release_video_workspace(context)
+        try:
+            await processing_msg.delete()
+        except:
+            pass  # Ignore if message can't be deleted
+
+# Remove the video job workspace and its user data
+def release_video_workspace(context):
+    workspace = context.user_data.pop('video_workspace', None)
+    if workspace:
+        workspaces.release(workspace)
+    
+    context.user_data.pop('video_input_path', None)
+    context.user_data.pop('video_unique_id', None)
+
+# Send a finished video note and remember it in the render cache
+async def send_video_note(update: Update, context: ContextTypes.DEFAULT_TYPE, output_path: str, result: dict, cache_key: str) -> int:
+    # Send as round video (video note)
+    try:
+        with open(output_path, 'rb') as video_file:
+            sent = await update.effective_message.reply_video_note(
+                video_file,
+                duration=int(result['duration']),
+                length=result['target_size']
+            )
+        # A render cut down by its deadline or load is not the answer for the next identical request
+        if not result.get('degraded'):
+            render_cache.put(cache_key, sent.video_note.file_id, result['duration'], result['target_size'])
+    except Exception as e:
+        await update.effective_message.reply_text(f"Failed to send video: {e}")
+
+    await update.effective_message.reply_text("Video note ready! Forward it to your channel.", reply_markup=markup)
+    context.user_data['state'] = CHOOSING
+    return CHOOSING
 
 # Handle vinyl image upload
 async def handle_vinyl_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -562,24 +2276,37 @@ async def handle_vinyl_image(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # Get the image file
         if update.message.photo:
             # Get the largest photo size
-            photo = update.message.photo[-1]
-            file = await photo.get_file()
+            image = update.message.photo[-1]
         else:
             # Document image
-            file = await update.message.document.get_file()
+            image = update.message.document
+        file = await image.get_file()
+        
+        # Each vinyl job gets its own workspace, replacing any previous one
+        release_vinyl_workspace(context)
+        workspace = workspaces.create('vinyl')
+        context.user_data['vinyl_workspace'] = workspace
+        workspaces.reserve(workspace, (image.file_size or 0) + WORKSPACE_OUTPUT_ALLOWANCE)
         
         # Download image
-        image_path = "vinyl_image." + file.file_path.split('.')[-1]
+        image_path = os.path.join(workspace, "vinyl_image." + file.file_path.split('.')[-1])
         await file.download_to_drive(image_path)
         
         # Store image path in user data
         context.user_data['vinyl_image_path'] = image_path
+        context.user_data['vinyl_image_uid'] = image.file_unique_id
         
         await update.message.reply_text("✅ Image received! Now send an audio file (MP3, WAV, etc.):")
         context.user_data['state'] = VINYL_AUDIO
         return VINYL_AUDIO
         
+    except WorkspaceQuotaError:
+        release_vinyl_workspace(context)
+        await update.message.reply_text("⚠️ The server is busy with other renders right now. Please send the image again in a minute.")
+        return VINYL_IMAGE
+    
     except Exception as e:
+        release_vinyl_workspace(context)
         await update.message.reply_text(f"Error processing image: {str(e)}")
         return VINYL_IMAGE
 
@@ -597,42 +2324,206 @@ async def handle_vinyl_audio(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("Please send a valid audio file")
         return VINYL_AUDIO
     
+    drop_lost_workspaces(context.user_data)
+    if 'vinyl_workspace' not in context.user_data:
+        # The cover was lost: the session outlived a restart, or sat idle until its files expired
+        await update.message.reply_text("Your cover image is gone, please send it again:")
+        context.user_data['state'] = VINYL_IMAGE
+        return VINYL_IMAGE
+    
+    render_scheduler.track(update.effective_user.id)
     try:
+        # Same cover and track already rendered in this user's profile: resend the finished vinyl
+        profile = context.user_data.get('encoding_profile', ENCODING_PROFILE)
+        cache_key = RenderCache.make_key(
+            'vinyl', [context.user_data.get('vinyl_image_uid'), audio.file_unique_id], render_cache_params('vinyl', profile)
+        )
+        if await send_cached_video_note(update, cache_key):
+            await update.message.reply_text("🎵 Vinyl record created! Forward it to your channel.", reply_markup=markup)
+            context.user_data['state'] = CHOOSING
+            return CHOOSING
+        context.user_data['vinyl_cache_key'] = cache_key
+        
         # Send initial processing message
         processing_msg = await update.message.reply_text("🎵 Processing vinyl... This may take a moment!")
         
-        # Download audio
+        workspace = context.user_data['vinyl_workspace']
         file = await audio.get_file()
-        audio_path = "vinyl_audio." + (file.file_path.split('.')[-1] if '.' in file.file_path else 'mp3')
-        await file.download_to_drive(audio_path)
+        extension = file.file_path.split('.')[-1].lower() if '.' in file.file_path else 'mp3'
+        audio_path = os.path.join(workspace, "vinyl_audio.m4a")
+        
+        # Keep only the first minute, already encoded as AAC for the final mux
+        streamed = False
+        if can_stream_ingest(file, audio.file_size, extension):
+            # Small, pipe-friendly uploads are decoded while they download
+            try:
+                await stream_ingest_vinyl_audio(file, audio_path, copy=extension == 'aac')
+                streamed = True
+            except (RuntimeError, httpx.HTTPError) as e:
+                print(f"Audio stream ingest failed, downloading instead: {e}")
+        if not streamed:
+            # Download audio
+            workspaces.reserve(workspace, audio.file_size or 0)
+            source_path = os.path.join(workspace, "vinyl_source." + extension)
+            await file.download_to_drive(source_path)
+            await ingest_vinyl_audio(source_path, audio_path)
+            os.remove(source_path)
         
         # Store audio path
         context.user_data['vinyl_audio_path'] = audio_path
+        context.user_data['vinyl_audio_ingested'] = True
         
-        # Create vinyl video with better error handling
-        try:
-            await create_vinyl_video_async(update, context, processing_msg)
-        except asyncio.TimeoutError:
-            # This shouldn't happen now, but just in case
-            await update.message.reply_text("⚠️ Processing is taking longer than expected, but your vinyl is still being created...")
-            # Continue processing in background
-            asyncio.create_task(create_vinyl_video_background(update, context))
+        # Let the user check the cover on a quick draft before the full render
+        if PREVIEW_ENABLED and await send_preview(update, build_vinyl_job(context, preview=True), processing_msg):
+            context.user_data['state'] = VINYL_PREVIEW
+            return VINYL_PREVIEW
+        
+        # Render deadlines bound the wait: late renders are restarted on a cheaper plan
+        await create_vinyl_video_async(update, context, processing_msg)
         
+    except WorkspaceQuotaError:
+        await update.message.reply_text("⚠️ The server is busy with other renders right now. Please try again in a minute.")
+    
+    except (RenderCancelledError, asyncio.CancelledError):
+        # /cancel or /stop already replied and freed the render slot
+        return context.user_data.get('state', CHOOSING)
+    
     except Exception as e:
         await update.message.reply_text(f"Error processing audio: {str(e)}")
-        # Clean up files
-        cleanup_vinyl_files(context)
+    
+    finally:
+        # Clean up files, even if the job failed or was cancelled (kept while a preview awaits confirmation)
+        if context.user_data.get('state') != VINYL_PREVIEW:
+            release_vinyl_workspace(context)
         
     context.user_data['state'] = CHOOSING
     return CHOOSING
 
+# Per-process cache of the vinyl overlay brightness effect, keyed by target size
+_vinyl_overlay_cache = {}
+
+def load_vinyl_overlay(target_size: int):
+    """Decode and resize the vinyl overlay once per process for each target size"""
+    if target_size not in _vinyl_overlay_cache:
+        effect = None
+        if os.path.exists(VINYL_OVERLAY_PATH):
+            vinyl_pil = PILImage.open(VINYL_OVERLAY_PATH).convert('RGB')
+            vinyl_pil = vinyl_pil.resize((target_size, target_size), PILImage.Resampling.LANCZOS)
+            
+            # Only the overlay brightness is used by the blend
+            vinyl_gray = np.mean(np.array(vinyl_pil, dtype=np.float32), axis=2)
+            effect = (vinyl_gray - 128) * VINYL_STRENGTH * 0.5
+        _vinyl_overlay_cache[target_size] = effect
+    return _vinyl_overlay_cache[target_size]
+
+# Blend the vinyl texture into a still cover frame
+def blend_vinyl_disc(user_frame, target_size: int):
+    """Apply the vinyl texture to the cover, preserving its hue and saturation"""
+    vinyl_effect = load_vinyl_overlay(target_size)
+    if vinyl_effect is None:
+        return user_frame
+    
+    user_pil = PILImage.fromarray(user_frame.astype('uint8')).convert('RGB')
+    
+    # Apply vinyl texture only to the V (brightness) channel
+    user_hsv_array = np.array(user_pil.convert('HSV'), dtype=np.float32)
+    user_hsv_array[:, :, 2] = np.clip(user_hsv_array[:, :, 2] + vinyl_effect, 0, 255)
+    
+    # Convert back to RGB
+    result_hsv = PILImage.fromarray(user_hsv_array.astype('uint8'), 'HSV')
+    blended_pil = result_hsv.convert('RGB')
+    
+    # Minimal post-processing to maintain colors
+    blended_pil = ImageEnhance.Contrast(blended_pil).enhance(1.02)
+    
+    return np.array(blended_pil)
+
+# Blank everything outside the inscribed circle of the disc
+def mask_vinyl_disc(disc_frame):
+    """Return a copy of the disc with black corners, so rotation leaves a static background"""
+    disc = np.array(disc_frame, dtype=np.uint8)
+    height, width = disc.shape[:2]
+    yy, xx = np.ogrid[:height, :width]
+    radius = min(height, width) / 2
+    disc[(yy - (height - 1) / 2) ** 2 + (xx - (width - 1) / 2) ** 2 > radius ** 2] = 0
+    return disc
+
+# One revolution of the spinning disc, rendered lazily and replayed for longer tracks
+class VinylFrameRing:
+    """Frame source that rotates the disc at most once per distinct angle"""
+    
+    def __init__(self, disc_frame, duration: float, fps: int = VINYL_FPS,
+                 degrees_per_second: float = VINYL_DEGREES_PER_SECOND,
+                 circular_mask: bool = True, max_bytes: int = VINYL_FRAME_CACHE_MB * 1024 * 1024):
+        self.fps = fps
+        self.step = degrees_per_second / fps
+        self.revolution = int(round(360 / self.step))
+        
+        # Blank the corners once so every rotated frame has the same static black background
+        disc = mask_vinyl_disc(disc_frame) if circular_mask else np.array(disc_frame, dtype=np.uint8)
+        self.disc_pil = PILImage.fromarray(disc)
+        
+        # Only frames that are replayed by a later revolution are worth keeping
+        total_frames = int(np.ceil(duration * fps))
+        reused_frames = min(max(total_frames - self.revolution, 0), self.revolution)
+        self.capacity = min(reused_frames, max_bytes // disc.nbytes)
+        self.frames = np.empty((self.capacity,) + disc.shape, dtype=np.uint8)
+        self.filled = np.zeros(self.capacity, dtype=bool)
+    
+    def frame_at(self, t):
+        index = int(round(t * self.fps)) % self.revolution
+        if index < self.capacity and self.filled[index]:
+            return self.frames[index]
+        
+        frame = np.asarray(self.disc_pil.rotate(-index * self.step, expand=False, fillcolor=(0, 0, 0)))
+        if index < self.capacity:
+            self.frames[index] = frame
+            self.filled[index] = True
+        return frame
+
+# Build the spinning disc clip from the blended cover
+def make_spinning_clip(disc_frame, duration: float, use_frame_cache: bool = VINYL_FRAME_CACHE):
+    """Spin the disc at VINYL_DEGREES_PER_SECOND, optionally through a one-revolution frame cache"""
+    if use_frame_cache:
+        ring = VinylFrameRing(disc_frame, duration)
+        return VideoClip(ring.frame_at, duration=duration)
+    
+    # Create rotation effect
+    def rotate_func(get_frame, t):
+        frame = get_frame(t)
+        angle = (t * VINYL_DEGREES_PER_SECOND) % 360
+        
+        pil_image = PILImage.fromarray(frame.astype('uint8'))
+        rotated = pil_image.rotate(-angle, expand=False, fillcolor=(0, 0, 0))
+        return np.array(rotated)
+    
+    return ImageClip(disc_frame, duration=duration).transform(rotate_func)
+
+# Compare frame generation speed of the spinning disc renderers
+def benchmark_vinyl_rotation(duration: float = 60, target_size: int = 512):
+    """Print frames/sec of the plain rotate chain versus the frame ring"""
+    disc_frame = (np.random.rand(target_size, target_size, 3) * 255).astype('uint8')
+    frame_count = int(duration * VINYL_FPS)
+    
+    results = {}
+    for label, use_frame_cache in [('transform(rotate_func)', False), ('VinylFrameRing', True)]:
+        clip = make_spinning_clip(disc_frame, duration, use_frame_cache=use_frame_cache)
+        started = time.perf_counter()
+        for i in range(frame_count):
+            clip.get_frame(i / VINYL_FPS)
+        results[label] = frame_count / (time.perf_counter() - started)
+        clip.close()
+        print(f"{label}: {results[label]:.1f} frames/sec")
+    
+    print(f"Speedup: {results['VinylFrameRing'] / results['transform(rotate_func)']:.2f}x")
+    return results
+
 # Create spinning vinyl video with async handling
 async def create_vinyl_video_async(update: Update, context: ContextTypes.DEFAULT_TYPE, processing_msg=None):
     """Main vinyl creation function with proper async handling"""
     try:
-        # Run the heavy processing in a thread pool to avoid blocking
-        loop = asyncio.get_event_loop()
-        success = await loop.run_in_executor(None, create_vinyl_video_sync, update, context)
+        # Run the heavy processing in the render pool to avoid blocking
+        success = await run_vinyl_job(update, context, processing_msg)
         
         if success:
             # Send the video
@@ -643,199 +2534,1023 @@ async def create_vinyl_video_async(update: Update, context: ContextTypes.DEFAULT
                 except:
                     pass  # Ignore if message can't be deleted
         else:
-            await update.message.reply_text("Failed to create vinyl video")
-            
+            await update.effective_message.reply_text("Failed to create vinyl video")
+    
+    except RenderCancelledError:
+        raise
     except Exception as e:
-        await update.message.reply_text(f"Failed to create vinyl: {str(e)}")
+        await update.effective_message.reply_text(f"Failed to create vinyl: {str(e)}")
     finally:
         # Clean up all files
-        cleanup_vinyl_files(context)
+        release_vinyl_workspace(context)
 
-# Background task for vinyl creation (fallback)
-async def create_vinyl_video_background(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Background task for when main processing times out"""
+# Describe the user's vinyl render as a job descriptor
+def build_vinyl_job(context: ContextTypes.DEFAULT_TYPE, preview: bool = False) -> dict:
+    workspace = context.user_data['vinyl_workspace']
+    return {
+        'kind': 'vinyl',
+        'image_path': context.user_data.get('vinyl_image_path'),
+        'audio_path': context.user_data.get('vinyl_audio_path'),
+        'disc_path': os.path.join(workspace, "vinyl_disc.png"),
+        'output_path': os.path.join(workspace, "vinyl_preview.mp4" if preview else "vinyl_video.mp4"),
+        'backend': context.user_data.get('render_backend', RENDER_BACKEND),
+        'profile': context.user_data.get('encoding_profile', ENCODING_PROFILE),
+        'audio_ingested': context.user_data.get('vinyl_audio_ingested', False),
+        'preview': preview,
+    }
+
+# Render the user's vinyl in the render scheduler
+async def run_vinyl_job(update: Update, context: ContextTypes.DEFAULT_TYPE, processing_msg=None) -> bool:
+    """Submit a vinyl job descriptor to the render scheduler and store the result in user data"""
+    job = build_vinyl_job(context)
+    output_path = job['output_path']
+    
     try:
-        loop = asyncio.get_event_loop()
-        success = await loop.run_in_executor(None, create_vinyl_video_sync, update, context)
-        
-        if success:
-            await send_vinyl_video(update, context)
-        else:
-            await update.message.reply_text("Failed to create vinyl video in background")
-            
+        result = await render_scheduler.run(job, update.effective_user.id, queue_position_notifier(processing_msg))
+    except RenderCancelledError:
+        raise
     except Exception as e:
-        await update.message.reply_text(f"Background vinyl creation failed: {str(e)}")
-    finally:
-        cleanup_vinyl_files(context)
+        print(f"Vinyl creation error: {e}")
+        return False
+    
+    # A render cut down by its deadline or load is not cached
+    if result.get('degraded'):
+        context.user_data.pop('vinyl_cache_key', None)
+    
+    # Store output path for sending
+    context.user_data['vinyl_output_path'] = output_path
+    context.user_data['vinyl_duration'] = result['duration']
+    context.user_data['vinyl_target_size'] = result['target_size']
+    return True
 
-# Synchronous vinyl creation (the heavy lifting)
-def create_vinyl_video_sync(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """Synchronous video creation that runs in thread pool"""
-    image_path = context.user_data.get('vinyl_image_path')
-    audio_path = context.user_data.get('vinyl_audio_path')
-    output_path = "vinyl_video.mp4"
-    vinyl_overlay_path = "vinyl_overlay.png"
+# Crop, resize and blend the cover into a vinyl disc frame
+def prepare_vinyl_disc(image_path: str, target_size: int):
+    """Load the user's image as a square, vinyl-textured disc"""
+    with PILImage.open(image_path) as image:
+        image = image.convert('RGB')
+        
+        # Make user image square and resize
+        size = min(image.width, image.height)
+        left = (image.width - size) // 2
+        top = (image.height - size) // 2
+        image = image.crop((left, top, left + size, top + size))
+        image = image.resize((target_size, target_size), PILImage.Resampling.LANCZOS)
+        
+        return blend_vinyl_disc(np.array(image), target_size)
+
+# Load the blended disc saved by an earlier render of the same job, or prepare it
+def load_vinyl_disc(image_path: str, disc_path: str = None):
+    """Return the masked 512 px disc, saving it to disc_path for later renders"""
+    if disc_path and os.path.exists(disc_path):
+        with PILImage.open(disc_path) as disc_image:
+            return np.array(disc_image.convert('RGB'))
     
-    try:
-        # Load audio and limit to 60 seconds
-        audio_clip = AudioFileClip(audio_path)
-        duration = min(audio_clip.duration, 60)
-        audio_clip = audio_clip.subclipped(0, duration)
+    disc_frame = mask_vinyl_disc(prepare_vinyl_disc(image_path, 512))
+    if disc_path:
+        PILImage.fromarray(disc_frame).save(disc_path)
+    return disc_frame
+
+# Render the spinning vinyl video note
+def render_vinyl_video(image_path: str, audio_path: str, output_path: str, backend: str = RENDER_BACKEND,
+                       copy_audio: bool = False, profile: str = ENCODING_PROFILE, preview: bool = False,
+                       disc_path: str = None, max_size: int = None, max_duration: float = None, on_progress=None):
+    """Spin the blended cover over the first minute of audio; returns (duration, target_size)
+
+    copy_audio muxes the audio as-is (ffmpeg backend), for audio that went through ingest_vinyl_audio.
+    preview renders a short, small draft. disc_path keeps the blended disc between the preview and
+    the full render, so the cover is only decoded and blended once. max_size, max_duration and
+    on_progress work as in render_video_note.
+    """
+    max_duration = min(PREVIEW_SECONDS if preview else 60, max_duration or 60)
+    target_size = min(PREVIEW_SIZE if preview else 512, max_size or 512)
+    disc_frame = load_vinyl_disc(image_path, disc_path)
+    if disc_frame.shape[0] != target_size:
+        disc_image = PILImage.fromarray(disc_frame).resize((target_size, target_size), PILImage.Resampling.LANCZOS)
+        disc_frame = mask_vinyl_disc(np.array(disc_image))
+    
+    if backend == 'ffmpeg':
+        duration = min(ffmpeg_parse_infos(audio_path)['duration'], max_duration)
+        preset, x264_params = x264_options(profile, duration)
+        frame_path = os.path.splitext(output_path)[0] + "_disc.png"
+        PILImage.fromarray(disc_frame).save(frame_path)
         
-        # Load and process user's image
-        user_image_clip = ImageClip(image_path, duration=duration)
+        # Loop the disc, rotate it and mux with the trimmed audio in a single pass
+        try:
+            run_ffmpeg([
+                '-loop', '1', '-framerate', str(VINYL_FPS), '-i', frame_path,
+                '-i', audio_path,
+                '-t', f"{duration:.3f}",
+                '-filter_complex', f"[0:v]rotate=a=t*{VINYL_DEGREES_PER_SECOND}*PI/180:c=black:bilinear=0,format=yuv420p[v]",
+                '-map', '[v]', '-map', '1:a:0',
+                '-c:v', 'libx264', '-preset', preset, *x264_params,
+                *(['-c:a', 'copy'] if copy_audio else ['-c:a', 'aac', '-b:a', f"{VIDEO_NOTE_AUDIO_KBPS}k"]),
+                output_path
+            ], on_progress, duration)
+        finally:
+            if os.path.exists(frame_path):
+                os.remove(frame_path)
+        return duration, target_size
+    
+    # Load audio and limit to 60 seconds
+    audio_clip = AudioFileClip(audio_path)
+    duration = min(audio_clip.duration, max_duration)
+    audio_clip = audio_clip.subclipped(0, duration)
+    
+    # Apply rotation to the blended vinyl and combine with audio
+    spinning_clip = make_spinning_clip(disc_frame, duration)
+    final_clip = spinning_clip.with_audio(audio_clip)
+    
+    # Write video with the encoding profile's settings
+    preset, x264_params = x264_options(profile, duration)
+    final_clip.write_videofile(
+        output_path,
+        codec="libx264",
+        audio_codec="aac",
+        audio_bitrate=f"{VIDEO_NOTE_AUDIO_KBPS}k",
+        preset=preset,
+        ffmpeg_params=x264_params,
+        temp_audiofile_path=os.path.dirname(output_path),  # Keep temp audio in the job workspace
+        logger=RenderProgressLogger(on_progress, duration) if on_progress else 'bar',
+        fps=VINYL_FPS
+    )
+    
+    # Clean up clips
+    final_clip.close()
+    audio_clip.close()
+    spinning_clip.close()
+    
+    return duration, target_size
+
+# Execute a render job descriptor (runs in a render worker process)
+def run_render_job(job: dict, on_progress=None) -> dict:
+    """Dispatch a picklable job descriptor to its renderer"""
+    profile = job.get('profile', ENCODING_PROFILE)
+    started = time.perf_counter()
+    limits = {
+        'preview': job.get('preview', False),
+        'max_size': job.get('max_size'),
+        'max_duration': job.get('max_duration'),
+        'on_progress': on_progress,
+    }
+    if job['kind'] == 'vinyl':
+        duration, target_size = render_vinyl_video(
+            job['image_path'], job['audio_path'], job['output_path'], job['backend'],
+            copy_audio=job.get('audio_ingested', False), profile=profile,
+            disc_path=job.get('disc_path'), **limits
+        )
+    elif job['kind'] == 'video_note':
+        duration, target_size = render_video_note(
+            job['input_path'], job['output_path'], job['backend'], profile=profile, **limits
+        )
+    else:
+        raise ValueError(f"Unknown render job kind: {job['kind']}")
+    return {
+        'duration': duration, 'target_size': target_size,
+        'profile': profile, 'render_seconds': time.perf_counter() - started,
+    }
+
+# Raised to the job's owner when their render is cancelled
+class RenderCancelledError(Exception):
+    pass
+
+# Raised when a user already has as many renders as they may queue
+class RenderQueueFullError(Exception):
+    pass
+
+# Raised when queued renders have no render-worker process to run them
+class RenderWorkersUnavailableError(Exception):
+    pass
+
+# Raised inside the scheduler when a running render is stopped to restart it with a cheaper plan
+class RenderOverBudgetError(Exception):
+    pass
+
+# Project a render attempt's finish time from its progress
+class RenderDeadline:
+    """Decides, from the progress of one attempt, whether it will miss the deadline and what to run instead
+
+    The ladder: first drop to 240 px with the 'fast' profile; if even that is projected late, keep only as
+    much of the clip as the measured speed fits into the time left. After that the attempt runs to the end.
+    """
+    
+    def __init__(self, job: dict, deadline: float):
+        self.job = job
+        self.deadline = deadline
+        self.started = time.perf_counter()
+        self.cheaper_job = None
+    
+    def on_progress(self, done: float, total: float) -> bool:
+        """Return False when the attempt should be stopped in favour of self.cheaper_job"""
+        now = time.perf_counter()
+        elapsed = now - self.started
+        if done <= 0 or elapsed < RENDER_DEADLINE_SAMPLE_SECONDS:
+            return True
         
-        # Make user image square and resize
-        size = min(user_image_clip.w, user_image_clip.h)
-        crop_effect = Crop(x_center=user_image_clip.w / 2, y_center=user_image_clip.h / 2, width=size, height=size)
-        user_image_clip = user_image_clip.with_effects([crop_effect])
+        projected_finish = now + elapsed * (total - done) / done
+        if projected_finish <= self.deadline:
+            return True
         
-        target_size = 512
-        user_image_clip = user_image_clip.resized((target_size, target_size))
+        self.cheaper_job = self.plan_cheaper(elapsed / done, total, self.deadline - now)
+        return self.cheaper_job is None
+    
+    def plan_cheaper(self, seconds_per_output_second: float, total: float, remaining: float):
+        job = self.job
+        if not job.get('max_size'):
+            return {**job, 'max_size': 240, 'profile': 'fast'}
+        if not job.get('max_duration'):
+            # Measured on the cheap plan, with a margin for the restart itself
+            fit = remaining * 0.8 / seconds_per_output_second
+            duration = max(RENDER_DEADLINE_MIN_SECONDS, fit)
+            if duration < total:
+                return {**job, 'max_duration': duration}
+        return None
+
+# Report render progress to the scheduler, at most every RENDER_PROGRESS_INTERVAL
+def progress_sender(conn):
+    last_sent = 0.0
+    
+    def on_progress(done: float, total: float):
+        nonlocal last_sent
+        now = time.perf_counter()
+        if now - last_sent >= RENDER_PROGRESS_INTERVAL:
+            last_sent = now
+            conn.send(('progress', (done, total)))
+    
+    return on_progress
+
+# Render worker loop: receives job descriptors and sends back results
+def render_worker_main(conn) -> None:
+    # Own process group, so a kill also takes down the ffmpeg processes the renderer started
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp()
+    
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        try:
+            conn.send(('ok', run_render_job(job, progress_sender(conn))))
+        except Exception as e:
+            conn.send(('error', str(e)))
+
+# A warm render process that can be killed mid-job
+class RenderWorker:
+    """One spawned worker process, reused across jobs until it is killed"""
+    
+    def __init__(self, mp_context):
+        self.mp_context = mp_context
+        self.process = None
+        self.conn = None
+        self.killed = False
+        self.reading = None  # (loop, fd, future) while run() waits for the pipe
+    
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive() and not self.killed
+    
+    def start(self):
+        # Spawned workers don't inherit the bot's event loop or HTTP connections
+        self.conn, child_conn = self.mp_context.Pipe()
+        self.process = self.mp_context.Process(target=render_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+    
+    async def run(self, job: dict, on_progress=None) -> dict:
+        """Run the job; on_progress(done_seconds, total_seconds) returning False kills it (RenderOverBudgetError)"""
+        if not self.alive:
+            self.start()
+        self.conn.send(job)
         
-        # Create vinyl blend effect
-        def create_vinyl_blend(get_frame, t):
-            from PIL import Image as PILImage, ImageEnhance
-            import numpy as np
-            
-            # Get user's image frame
-            user_frame = get_frame(t)
-            user_pil = PILImage.fromarray(user_frame.astype('uint8')).convert('RGB')
+        while True:
+            await self.wait_readable()
+            if self.killed:
+                raise RenderCancelledError("Render cancelled")
+            try:
+                status, payload = self.conn.recv()
+            except (EOFError, OSError):
+                if self.killed:
+                    raise RenderCancelledError("Render cancelled")
+                self.killed = True
+                raise RuntimeError("Render worker exited unexpectedly")
             
-            # Load vinyl overlay (do this once and cache if needed)
-            if os.path.exists(vinyl_overlay_path):
-                vinyl_pil = PILImage.open(vinyl_overlay_path).convert('RGB')
-                vinyl_pil = vinyl_pil.resize((target_size, target_size), PILImage.Resampling.LANCZOS)
-                
-                # Convert images to numpy arrays for blending
-                user_array = np.array(user_pil, dtype=np.float32)
-                vinyl_array = np.array(vinyl_pil, dtype=np.float32)
-                
-                # More color-preserving vinyl texture blend
-                vinyl_strength = 0.4
-                
-                # Convert to HSV to preserve hue and saturation
-                user_hsv = user_pil.convert('HSV')
-                user_hsv_array = np.array(user_hsv, dtype=np.float32)
-                
-                # Apply vinyl texture only to the V (brightness) channel
-                vinyl_gray = np.mean(vinyl_array, axis=2)
-                vinyl_brightness_effect = (vinyl_gray - 128) * vinyl_strength * 0.5
-                
-                # Apply effect only to brightness channel
-                user_hsv_array[:, :, 2] = np.clip(user_hsv_array[:, :, 2] + vinyl_brightness_effect, 0, 255)
-                
-                # Convert back to RGB
-                result_hsv = PILImage.fromarray(user_hsv_array.astype('uint8'), 'HSV')
-                blended_pil = result_hsv.convert('RGB')
-                
-                # Minimal post-processing to maintain colors
-                enhancer = ImageEnhance.Contrast(blended_pil)
-                blended_pil = enhancer.enhance(1.02)
-                
-                return np.array(blended_pil)
+            if status == 'progress':
+                if on_progress and on_progress(*payload) is False:
+                    self.kill()
+                    raise RenderOverBudgetError("Render would miss its deadline")
+                continue
+            if status == 'error':
+                raise RuntimeError(payload)
+            return payload
+    
+    async def wait_readable(self):
+        # Wait for a message (or for the pipe to close when the worker dies) without a thread
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        fd = self.conn.fileno()
+        loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+        self.reading = (loop, fd, readable)
+        try:
+            await readable
+        finally:
+            if self.reading is not None and self.reading[2] is readable:
+                self.reading = None
+                loop.remove_reader(fd)
+    
+    def stop_reading(self):
+        # Wake a pending wait_readable() and drop its reader before kill() closes the fd it watches
+        if self.reading is None:
+            return
+        loop, fd, readable = self.reading
+        self.reading = None
+        loop.remove_reader(fd)
+        if not readable.done():
+            readable.set_result(None)
+    
+    def kill(self):
+        """Stop the worker and everything it started, right now; a pending run() raises RenderCancelledError"""
+        self.killed = True
+        self.stop_reading()
+        if self.process is None:
+            return
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(self.process.pid, signal.SIGKILL)
             else:
-                return user_frame
-        
-        # Apply vinyl blend effect
-        vinyl_blend_clip = user_image_clip.transform(create_vinyl_blend)
+                self.process.kill()
+        except (ProcessLookupError, PermissionError):
+            self.process.kill()  # Gone, or still starting up and not yet leading its own process group
+        self.process.join(timeout=1)
+        self.conn.close()
+    
+    def stop(self):
+        if self.alive:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+            self.process.join(timeout=1)
+        if self.process is not None and self.process.is_alive():
+            self.kill()
+
+# Durable render jobs shared by the bot and `render-worker` processes
+class RenderJobQueue:
+    """SQLite rows with leases: a claimed job belongs to its worker while heartbeats keep extending the lease
+
+    A job whose lease runs out (the worker died) can be claimed again, up to max_attempts claims. The bot
+    deletes a row once it has read the outcome, and deleting a job is also how it is cancelled.
+    """
+    
+    def __init__(self, path: str, lease_seconds: float, max_attempts: int):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.connection = None
+    
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            # Autocommit, so claim() can take the write lock before it reads
+            self.connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS render_jobs ("
+                "id INTEGER PRIMARY KEY, job TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER DEFAULT 0, "
+                "owner TEXT, lease_expires REAL, progress TEXT, result TEXT, error TEXT, created_at REAL, updated_at REAL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS render_jobs_status ON render_jobs (status, id)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS render_workers (owner TEXT PRIMARY KEY, seen_at REAL)")
+        return self.connection
+    
+    def announce(self, owner: str) -> None:
+        """Mark a worker process as alive, busy or not"""
+        self.connect().execute("INSERT OR REPLACE INTO render_workers (owner, seen_at) VALUES (?, ?)", (owner, time.time()))
+    
+    def retire(self, owner: str) -> None:
+        self.connect().execute("DELETE FROM render_workers WHERE owner = ?", (owner,))
+    
+    def workers_seen(self, within: float) -> int:
+        return self.connect().execute(
+            "SELECT COUNT(*) FROM render_workers WHERE seen_at >= ?", (time.time() - within,)
+        ).fetchone()[0]
+    
+    def enqueue(self, job: dict) -> int:
+        now = time.time()
+        return self.connect().execute(
+            "INSERT INTO render_jobs (job, status, created_at, updated_at) VALUES (?, 'queued', ?, ?)",
+            (json.dumps(job), now, now)
+        ).lastrowid
+    
+    def claim(self, owner: str):
+        """Lease the oldest claimable job to owner; returns (job id, job) or None"""
+        connection = self.connect()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "UPDATE render_jobs SET status = 'failed', error = ?, updated_at = ? "
+                "WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+                (f"Render worker died {self.max_attempts} times on this job", now, now, self.max_attempts)
+            )
+            row = connection.execute(
+                "SELECT id, job FROM render_jobs WHERE status = 'queued' OR (status = 'running' AND lease_expires < ?) "
+                "ORDER BY id LIMIT 1", (now,)
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE render_jobs SET status = 'running', owner = ?, lease_expires = ?, attempts = attempts + 1, "
+                    "updated_at = ? WHERE id = ?", (owner, now + self.lease_seconds, now, row[0])
+                )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        metrics.increment('render_queue.claimed')
+        return row[0], json.loads(row[1])
+    
+    def heartbeat(self, job_id: int, owner: str, progress=None) -> bool:
+        """Extend the lease; False means the job is no longer this owner's to run"""
+        now = time.time()
+        cursor = self.connect().execute(
+            "UPDATE render_jobs SET lease_expires = ?, progress = ?, updated_at = ? "
+            "WHERE id = ? AND owner = ? AND status = 'running'",
+            (now + self.lease_seconds, json.dumps(progress), now, job_id, owner)
+        )
+        return cursor.rowcount == 1
+    
+    def complete(self, job_id: int, owner: str, result: dict) -> None:
+        self.connect().execute(
+            "UPDATE render_jobs SET status = 'done', result = ?, updated_at = ? WHERE id = ? AND owner = ? AND status = 'running'",
+            (json.dumps(result), time.time(), job_id, owner)
+        )
+    
+    def fail(self, job_id: int, owner: str, error: str, retry: bool = False) -> None:
+        self.connect().execute(
+            "UPDATE render_jobs SET status = CASE WHEN ? AND attempts < ? THEN 'queued' ELSE 'failed' END, "
+            "error = ?, updated_at = ? WHERE id = ? AND owner = ? AND status = 'running'",
+            (retry, self.max_attempts, error, time.time(), job_id, owner)
+        )
+    
+    def release(self, job_id: int, owner: str) -> None:
+        """Give a job back untried, e.g. when its worker is shutting down"""
+        self.connect().execute(
+            "UPDATE render_jobs SET status = 'queued', attempts = attempts - 1, updated_at = ? "
+            "WHERE id = ? AND owner = ? AND status = 'running'", (time.time(), job_id, owner)
+        )
+    
+    def get(self, job_id: int):
+        row = self.connect().execute(
+            "SELECT status, progress, result, error, attempts, lease_expires FROM render_jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            'status': row[0], 'progress': json.loads(row[1]) if row[1] else None,
+            'result': json.loads(row[2]) if row[2] else None, 'error': row[3], 'attempts': row[4],
+            'lease_expires': row[5],
+        }
+    
+    def delete(self, job_id: int) -> None:
+        self.connect().execute("DELETE FROM render_jobs WHERE id = ?", (job_id,))
+    
+    def purge(self, older_than: float) -> None:
+        self.connect().execute("DELETE FROM render_jobs WHERE updated_at < ?", (time.time() - older_than,))
+    
+    def format_stats(self) -> str:
+        counts = dict(self.connect().execute("SELECT status, COUNT(*) FROM render_jobs GROUP BY status").fetchall())
+        return (
+            f"Render queue: {counts.get('queued', 0)} queued, {counts.get('running', 0)} running, "
+            f"workers alive: {self.workers_seen(self.lease_seconds)}"
+        )
+
+# Stand-in for RenderWorker that runs jobs on `render-worker` processes through the render job queue
+class QueuedRenderWorker:
+    def __init__(self, queue: RenderJobQueue):
+        self.queue = queue
+        self.job_id = None
+    
+    @property
+    def alive(self) -> bool:
+        return True  # Nothing local to die; reusable for the next job
+    
+    async def run(self, job: dict, on_progress=None) -> dict:
+        """Same contract as RenderWorker.run; progress arrives with the remote worker's heartbeats"""
+        self.job_id = job_id = self.queue.enqueue(job)
+        enqueued = time.monotonic()
+        last_progress = None
+        try:
+            while True:
+                await asyncio.sleep(RENDER_QUEUE_POLL_INTERVAL)
+                state = self.queue.get(job_id)
+                if state is None:
+                    raise RenderCancelledError("Render cancelled")
+                # Never claimed, or its worker died mid-job: either way no live worker is left to pick it up
+                unclaimed = state['status'] == 'queued' and time.monotonic() - enqueued >= self.queue.lease_seconds
+                orphaned = state['status'] == 'running' and state['lease_expires'] < time.time()
+                if (unclaimed or orphaned) and not self.queue.workers_seen(self.queue.lease_seconds):
+                    metrics.increment('render_queue.no_workers')
+                    raise RenderWorkersUnavailableError("Rendering is temporarily unavailable, please try again later")
+                if state['status'] == 'done':
+                    if state['attempts'] > 1:
+                        metrics.increment('render_queue.retried')
+                    return state['result']
+                if state['status'] == 'failed':
+                    raise RuntimeError(state['error'])
+                if on_progress and state['progress'] and state['progress'] != last_progress:
+                    last_progress = state['progress']
+                    if on_progress(*state['progress']) is False:
+                        raise RenderOverBudgetError("Render would miss its deadline")
+        finally:
+            # Deleting also cancels the job if it is still queued or running
+            self.queue.delete(job_id)
+            self.job_id = None
+    
+    def kill(self):
+        if self.job_id is not None:
+            self.queue.delete(self.job_id)
+    
+    def stop(self):
+        pass
+
+# A job waiting for, or holding, a render slot
+class RenderEntry:
+    def __init__(self, user_id, priority: int, future, on_position=None):
+        self.user_id = user_id
+        self.priority = priority
+        self.future = future
+        self.on_position = on_position
+        self.last_position = None
+        self.notifier = None  # Task sending position updates one at a time, so they can't arrive out of order
+        self.queued_at = time.perf_counter()
+        self.worker = None
+    
+    def notify(self, position: int):
+        """Queue a position update; returns the task that sends it (None without on_position)"""
+        self.last_position = position
+        if self.on_position and (self.notifier is None or self.notifier.done()):
+            self.notifier = asyncio.create_task(self.send_positions())
+        return self.notifier
+    
+    async def send_positions(self):
+        # Skip positions that went stale while an edit was in flight; only the latest one matters
+        sent = None
+        while sent != self.last_position:
+            sent = self.last_position
+            try:
+                await self.on_position(sent)
+            except Exception as e:
+                print(f"Queue position update failed: {e}")
+
+# Central scheduler for every media render
+class RenderScheduler:
+    """Global and per-user concurrency caps, round-robin fairness between users, previews first.
+
+    Waiting jobs are told their queue position; cancel(user_id) drops the user's waiting jobs and
+    kills their running worker, freeing its slot immediately.
+    """
+    
+    def __init__(self, workers: int, user_running_limit: int = 1, user_queue_limit: int = 2, worker_factory=None):
+        self.workers = max(1, workers)
+        self.user_running_limit = max(1, user_running_limit)
+        self.user_queue_limit = max(1, user_queue_limit)
+        self.mp_context = multiprocessing.get_context('spawn')
+        self.worker_factory = worker_factory or (lambda: RenderWorker(self.mp_context))
+        self.idle_workers = []
+        self.running = []
+        self.waiting = {}  # user_id -> entries in arrival order
+        self.rotation = deque()  # User ids, least recently served first
+        self.tasks = {}  # user_id -> handler tasks preparing or awaiting a render
+    
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(entries) for entries in self.waiting.values())
+    
+    def user_jobs(self, user_id) -> int:
+        running = sum(1 for entry in self.running if entry.user_id == user_id)
+        return running + len(self.waiting.get(user_id, []))
+    
+    def track(self, user_id):
+        """Register the current handler task, so cancel() also stops its download and probe stages"""
+        task = asyncio.current_task()
+        self.tasks.setdefault(user_id, set()).add(task)
+        task.add_done_callback(lambda done: self.tasks.get(user_id, set()).discard(done))
+    
+    async def run(self, job: dict, user_id, on_position=None) -> dict:
+        """Wait for a slot, then render the job; on_position(n) is awaited with the queue position (0 = started)"""
+        if self.user_jobs(user_id) >= self.user_queue_limit:
+            metrics.increment('render.rejected')
+            raise RenderQueueFullError("You already have renders in progress")
         
-        # Create rotation effect
-        def rotate_func(get_frame, t):
-            frame = get_frame(t)
-            angle = (t * 12) % 360
+        # Waiting counts as use too: the job's files must outlive the queue
+        with workspaces.in_use(os.path.dirname(job['output_path'])):
+            entry = RenderEntry(user_id, 0 if job.get('preview') else 1, asyncio.get_running_loop().create_future(), on_position)
+            self.waiting.setdefault(user_id, []).append(entry)
+            if user_id not in self.rotation:
+                self.rotation.appendleft(user_id)  # Never served yet
+            self.dispatch()
+            self.notify_positions()
             
-            from PIL import Image as PILImage
-            import numpy as np
+            try:
+                await entry.future
+            except asyncio.CancelledError:
+                self.discard(entry)
+                raise
+            metrics.observe('render.wait', time.perf_counter() - entry.queued_at)
             
-            pil_image = PILImage.fromarray(frame.astype('uint8'))
-            rotated = pil_image.rotate(-angle, expand=False, fillcolor=(0, 0, 0))
-            return np.array(rotated)
-        
-        # Apply rotation to the blended vinyl
-        spinning_clip = vinyl_blend_clip.transform(rotate_func)
-        
-        # Combine with audio
-        final_clip = spinning_clip.with_audio(audio_clip)
-        
-        # Write video with optimized settings
-        final_clip.write_videofile(
-            output_path,
-            codec="libx264",
-            audio_codec="aac",
-            bitrate="500k",
-            fps=24
-        )
-        
-        # Clean up clips
-        final_clip.close()
-        audio_clip.close()
-        user_image_clip.close()
-        vinyl_blend_clip.close()
-        spinning_clip.close()
-        
-        # Store output path for sending
-        context.user_data['vinyl_output_path'] = output_path
-        context.user_data['vinyl_duration'] = duration
-        context.user_data['vinyl_target_size'] = target_size
+            try:
+                if on_position:
+                    await entry.notify(0)
+                profile = self.select_profile(job)
+                downgraded = not job.get('preview') and profile != job.get('profile', ENCODING_PROFILE)
+                job = {**job, 'profile': profile}
+                result = await self.run_with_deadline(entry, job)
+                self.record(job, result)
+                if downgraded:
+                    # Not the quality the user asked for, so it must not answer their next identical request
+                    result = {**result, 'degraded': True}
+                return result
+            except RenderCancelledError:
+                metrics.increment('render.cancelled')
+                raise
+            except asyncio.CancelledError:
+                entry.worker.kill()  # A deadline restart may have replaced the worker the entry started with
+                metrics.increment('render.cancelled')
+                raise
+            finally:
+                self.release(entry)
+    
+    async def run_with_deadline(self, entry, job: dict) -> dict:
+        """Run the job on the entry's worker, restarting it on a cheaper plan if it is projected to finish late"""
+        if not RENDER_DEADLINE_SECONDS or job.get('preview'):
+            return await entry.worker.run(job)
         
+        deadline = entry.queued_at + RENDER_DEADLINE_SECONDS
+        while True:
+            attempt = RenderDeadline(job, deadline)
+            try:
+                result = await entry.worker.run(job, attempt.on_progress)
+            except RenderOverBudgetError:
+                step = 'shortened' if 'max_duration' in attempt.cheaper_job else 'downscaled'
+                print(f"Render of {job['kind']} over budget, restarting {step}")
+                metrics.increment(f"render.deadline.{step}")
+                job = attempt.cheaper_job
+                entry.worker = self.idle_workers.pop() if self.idle_workers else self.worker_factory()
+                continue
+            
+            if time.perf_counter() > deadline:
+                metrics.increment('render.deadline.missed')
+            metrics.observe('render.total', time.perf_counter() - entry.queued_at)
+            return {**result, 'degraded': 'max_size' in job}
+    
+    def next_entry(self):
+        # Lowest priority value first; among equals, the user served least recently
+        best = None
+        for user_id in self.rotation:
+            entries = self.waiting.get(user_id)
+            if not entries:
+                continue
+            if sum(1 for entry in self.running if entry.user_id == user_id) >= self.user_running_limit:
+                continue
+            candidate = min(entries, key=lambda entry: entry.priority)
+            if best is None or candidate.priority < best.priority:
+                best = candidate
+        return best
+    
+    def dispatch(self):
+        """Hand free slots to waiting jobs"""
+        while len(self.running) < self.workers:
+            entry = self.next_entry()
+            if entry is None:
+                return
+            self.remove_waiting(entry)
+            self.rotation.remove(entry.user_id)
+            self.rotation.append(entry.user_id)
+            if entry.future.done():
+                continue  # Cancelled while waiting
+            
+            entry.worker = self.idle_workers.pop() if self.idle_workers else self.worker_factory()
+            self.running.append(entry)
+            entry.future.set_result(entry.worker)
+    
+    def remove_waiting(self, entry) -> bool:
+        entries = self.waiting.get(entry.user_id, [])
+        if entry not in entries:
+            return False
+        entries.remove(entry)
+        if not entries:
+            del self.waiting[entry.user_id]
         return True
-        
+    
+    def discard(self, entry):
+        # A job cancelled before it started: give back its place or its freshly granted slot
+        if self.remove_waiting(entry):
+            self.notify_positions()
+        else:
+            self.release(entry)
+    
+    def release(self, entry):
+        if entry not in self.running:
+            return  # Already released by cancel()
+        self.running.remove(entry)
+        if entry.worker.alive:
+            self.idle_workers.append(entry.worker)
+        self.dispatch()
+        self.notify_positions()
+    
+    def cancel(self, user_id) -> int:
+        """Drop the user's waiting jobs and kill their running ones; returns the number of jobs cancelled"""
+        cancelled = 0
+        for task in self.tasks.pop(user_id, set()):
+            if task is not asyncio.current_task() and not task.done():
+                task.cancel()
+                cancelled += 1
+        for entry in list(self.waiting.get(user_id, [])):
+            self.remove_waiting(entry)
+            if not entry.future.done():
+                entry.future.set_exception(RenderCancelledError("Render cancelled"))
+            cancelled += 1
+        for entry in [entry for entry in self.running if entry.user_id == user_id]:
+            entry.worker.kill()
+            self.release(entry)
+            cancelled += 1
+        if cancelled:
+            metrics.increment('render.user_cancels')
+            self.dispatch()
+            self.notify_positions()
+        return cancelled
+    
+    def select_profile(self, job: dict) -> str:
+        if job.get('preview'):
+            return 'preview'
+        # Trade quality for throughput while other jobs are piling up
+        if self.queue_depth >= ENCODING_FAST_QUEUE_DEPTH:
+            metrics.increment('render.profile_downgrades')
+            return 'fast'
+        return job.get('profile', ENCODING_PROFILE)
+    
+    def record(self, job: dict, result: dict) -> None:
+        profile = result['profile']
+        metrics.increment(f"render.{job['kind']}.{profile}")
+        metrics.observe(f"render.{job['kind']}.{profile}", result['render_seconds'])
+        # Encode speed: wall seconds per second of output, comparable across clip lengths
+        metrics.observe(f"encode_speed.{profile}", result['render_seconds'] / max(result['duration'], 0.1))
+    
+    def queue_order(self) -> list:
+        # Predicted start order: priority, then one job per user per round in rotation order
+        ranked = []
+        for rotation_index, user_id in enumerate(self.rotation):
+            for round_index, entry in enumerate(self.waiting.get(user_id, [])):
+                ranked.append(((entry.priority, round_index, rotation_index), entry))
+        return [entry for _, entry in sorted(ranked, key=lambda item: item[0])]
+    
+    def notify_positions(self):
+        # Only tell users whose position actually changed
+        for position, entry in enumerate(self.queue_order(), start=1):
+            if entry.on_position and position != entry.last_position:
+                entry.notify(position)
+    
+    def format_stats(self) -> str:
+        wait = metrics.snapshot()['timings'].get('render.wait')
+        lines = [
+            f"Render workers: {len(self.running)}/{self.workers} busy",
+            f"Queue depth: {self.queue_depth} ({len(self.waiting)} users waiting)",
+        ]
+        if wait:
+            lines.append(f"Queue wait: avg={wait['avg']:.2f}s max={wait['max']:.2f}s over {wait['count']} jobs")
+        return "\n".join(lines)
+    
+    def shutdown(self):
+        for entry in list(self.running):
+            entry.worker.kill()
+        for worker in self.idle_workers:
+            worker.stop()
+        self.idle_workers = []
+
+render_job_queue = RenderJobQueue(RENDER_QUEUE_PATH, RENDER_QUEUE_LEASE_SECONDS, RENDER_QUEUE_MAX_ATTEMPTS)
+
+if RENDER_QUEUE_ENABLED:
+    render_scheduler = RenderScheduler(
+        RENDER_QUEUE_SLOTS, RENDER_USER_RUNNING_LIMIT, RENDER_USER_QUEUE_LIMIT,
+        worker_factory=lambda: QueuedRenderWorker(render_job_queue)
+    )
+else:
+    render_scheduler = RenderScheduler(RENDER_WORKERS, RENDER_USER_RUNNING_LIMIT, RENDER_USER_QUEUE_LIMIT)
+
+# Render worker process mode: claim queued jobs and run them on local warm workers
+async def run_render_queue_worker(queue, slots: int) -> None:
+    """Each slot renders one job at a time; SIGTERM puts running jobs back in the queue for another worker"""
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    mp_context = multiprocessing.get_context('spawn')
+    stop_event = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(signum, stop_event.set)
+    
+    async def slot_loop():
+        worker = RenderWorker(mp_context)
+        while not stop_event.is_set():
+            claimed = queue.claim(owner)
+            if claimed is None:
+                try:
+                    await asyncio.wait_for(stop_event.wait(), RENDER_QUEUE_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await run_claimed_job(queue, owner, worker, *claimed, stop_event)
+            if not worker.alive:
+                worker = RenderWorker(mp_context)
+        worker.stop()
+    
+    async def announce_loop():
+        while not stop_event.is_set():
+            queue.announce(owner)
+            try:
+                await asyncio.wait_for(stop_event.wait(), RENDER_QUEUE_HEARTBEAT)
+            except asyncio.TimeoutError:
+                pass
+        queue.retire(owner)
+    
+    print(f"Render worker {owner} running with {slots} slots...")
+    await asyncio.gather(announce_loop(), *(slot_loop() for _ in range(slots)))
+
+# Run one claimed job, heartbeating its lease until it finishes, is cancelled or the worker stops
+async def run_claimed_job(queue, owner: str, worker, job_id: int, job: dict, stop_event) -> None:
+    progress = None
+    
+    def on_progress(done: float, total: float):
+        nonlocal progress
+        progress = (done, total)
+    
+    task = asyncio.create_task(worker.run(job, on_progress))
+    stopping = asyncio.create_task(stop_event.wait())
+    try:
+        while not task.done():
+            await asyncio.wait({task, stopping}, timeout=RENDER_QUEUE_HEARTBEAT, return_when=asyncio.FIRST_COMPLETED)
+            if task.done():
+                break
+            if stop_event.is_set():
+                worker.kill()
+                queue.release(job_id, owner)
+                return
+            if not queue.heartbeat(job_id, owner, progress):
+                # Cancelled by the bot, or our lease ran out and another worker took over
+                worker.kill()
+                metrics.increment('render_queue.abandoned')
+                return
+    finally:
+        stopping.cancel()
+        if not task.done():
+            task.cancel()  # The render was killed or abandoned; its outcome no longer matters
+            await asyncio.wait({task})
+    
+    try:
+        result = task.result()
     except Exception as e:
-        print(f"Vinyl creation error: {e}")
-        return False
+        # A render process that died (crash, OOM) may succeed elsewhere; a failing renderer won't
+        queue.fail(job_id, owner, str(e), retry=not worker.alive)
+        print(f"Render job {job_id} failed: {e}")
+        return
+    queue.complete(job_id, owner, result)
+
+# Keep the user's processing message updated with their place in the render queue
+def queue_position_notifier(processing_msg):
+    """Return an on_position callback that edits processing_msg"""
+    if processing_msg is None:
+        return None
+    
+    async def on_position(position: int):
+        if position == 0:
+            text = "⚙️ Rendering... This may take a moment!"
+        else:
+            text = f"⏳ Waiting for a free renderer. You are #{position} in the queue."
+        try:
+            await processing_msg.edit_text(text)
+        except Exception:
+            pass  # Ignore unchanged or deleted messages
+    
+    return on_position
+
+# Serve short link redirects from the bot process when configured
+async def start_services(application) -> None:
+    application.bot_data['workspace_sweeper'] = asyncio.create_task(expire_idle_workspaces())
+    if RENDER_QUEUE_ENABLED:
+        render_job_queue.purge(RENDER_QUEUE_RETENTION)
+    if LOCAL_SHORTENER_IN_PROCESS and not REDIRECTS_ON_WEBHOOK:
+        server = await RedirectServer(local_link_store, LOCAL_SHORTENER_HOST, LOCAL_SHORTENER_PORT).start()
+        application.bot_data['redirect_server'] = server
+        print(f"Redirect server listening on port {server.port}")
+
+# Give back the files and quota of sessions that were abandoned mid-job
+async def expire_idle_workspaces() -> None:
+    while True:
+        await asyncio.sleep(WORKSPACE_SWEEP_INTERVAL)
+        expired = workspaces.expire(WORKSPACE_IDLE_SECONDS)
+        if expired:
+            metrics.increment('workspaces.expired', expired)
+
+# Stop render workers and the redirect server with the application
+async def shutdown_services(application) -> None:
+    sweeper = application.bot_data.pop('workspace_sweeper', None)
+    if sweeper:
+        sweeper.cancel()
+    render_scheduler.shutdown()
+    server = application.bot_data.pop('redirect_server', None)
+    if server:
+        await server.close()
+
+# Run only the redirect server; it reads the bot's link store, so it must share its host
+async def serve_redirects() -> None:
+    server = await RedirectServer(local_link_store, LOCAL_SHORTENER_HOST, LOCAL_SHORTENER_PORT).start()
+    print(f"Redirect server listening on port {server.port}")
+    await server.server.serve_forever()
 
 # Send the completed vinyl video
 async def send_vinyl_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send the vinyl video as a video note"""
     try:
-        output_path = context.user_data.get('vinyl_output_path', 'vinyl_video.mp4')
+        output_path = context.user_data.get('vinyl_output_path')
         duration = context.user_data.get('vinyl_duration', 30)
         target_size = context.user_data.get('vinyl_target_size', 512)
         
-        if os.path.exists(output_path):
+        if output_path and os.path.exists(output_path):
             with open(output_path, 'rb') as video_file:
-                await update.message.reply_video_note(
+                sent = await update.effective_message.reply_video_note(
                     video_file,
                     duration=int(duration),
                     length=target_size
                 )
             
-            await update.message.reply_text("🎵 Vinyl record created! Forward it to your channel.", reply_markup=markup)
+            cache_key = context.user_data.get('vinyl_cache_key')
+            if cache_key:
+                render_cache.put(cache_key, sent.video_note.file_id, duration, target_size)
+            
+            await update.effective_message.reply_text("🎵 Vinyl record created! Forward it to your channel.", reply_markup=markup)
             
             # Clean up output file
             os.remove(output_path)
         else:
-            await update.message.reply_text("Vinyl video file not found")
+            await update.effective_message.reply_text("Vinyl video file not found")
             
     except Exception as e:
-        await update.message.reply_text(f"Failed to send vinyl: {str(e)}")
+        await update.effective_message.reply_text(f"Failed to send vinyl: {str(e)}")
 
-# Clean up vinyl files
-def cleanup_vinyl_files(context):
-    image_path = context.user_data.get('vinyl_image_path')
-    audio_path = context.user_data.get('vinyl_audio_path')
-    output_path = context.user_data.get('vinyl_output_path', 'vinyl_video.mp4')
+# Handle the confirm/redo buttons under a vinyl preview
+async def handle_vinyl_preview(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    try:
+        await query.edit_message_reply_markup(reply_markup=None)
+    except Exception:
+        pass  # Buttons already removed
     
-    for path in [image_path, audio_path, output_path]:
-        if path and os.path.exists(path):
-            try:
-                os.remove(path)
-            except:
-                pass  # Ignore cleanup errors
+    drop_lost_workspaces(context.user_data)
+    if query.data == 'preview:redo' or 'vinyl_audio_path' not in context.user_data:
+        metrics.increment('preview.vinyl.redo')
+        release_vinyl_workspace(context)
+        await query.message.reply_text("Send a new image for the vinyl cover:")
+        context.user_data['state'] = VINYL_IMAGE
+        return VINYL_IMAGE
+    
+    # The full render reuses the downloaded cover, the blended disc and the ingested audio
+    render_scheduler.track(update.effective_user.id)
+    processing_msg = await query.message.reply_text("🎵 Rendering the full vinyl...")
+    try:
+        await create_vinyl_video_async(update, context, processing_msg)
+    except (RenderCancelledError, asyncio.CancelledError):
+        return context.user_data.get('state', CHOOSING)
+    context.user_data['state'] = CHOOSING
+    return CHOOSING
+
+# Remove the vinyl job workspace and its user data
+def release_vinyl_workspace(context):
+    workspace = context.user_data.pop('vinyl_workspace', None)
+    if workspace:
+        workspaces.release(workspace)
     
     # Clear from user data
     context.user_data.pop('vinyl_image_path', None)
+    context.user_data.pop('vinyl_image_uid', None)
     context.user_data.pop('vinyl_audio_path', None)
+    context.user_data.pop('vinyl_audio_ingested', None)
+    context.user_data.pop('vinyl_cache_key', None)
     context.user_data.pop('vinyl_output_path', None)
     context.user_data.pop('vinyl_duration', None)
     context.user_data.pop('vinyl_target_size', None)
 
 # Cancel
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    # Kill any render in flight first, so its files can be removed
+    render_scheduler.cancel(update.effective_user.id)
+    
     # Clean up any vinyl files if in vinyl creation process
-    if context.user_data.get('state') in [VINYL_IMAGE, VINYL_AUDIO]:
-        cleanup_vinyl_files(context)
+    if context.user_data.get('state') in [VINYL_IMAGE, VINYL_AUDIO, VINYL_PREVIEW]:
+        release_vinyl_workspace(context)
+    
+    # Clean up a video waiting for preview confirmation
+    if context.user_data.get('state') in [VIDEO, VIDEO_PREVIEW]:
+        release_video_workspace(context)
     
     # Clean up UTM data if in UTM creation process
     if context.user_data.get('state') in [UTM_URL, UTM_SOURCE, UTM_CAMPAIGN]:
@@ -845,13 +3560,342 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         context.user_data.pop('utm_platform', None)
         context.user_data.pop('suggested_campaign', None)
     
-    await update.message.reply_text("Operation cancelled. What next?", reply_markup=markup)
+    # Set before awaiting: the cancelled handler returns this state, and PTB ignores ours while it is pending
     context.user_data['state'] = CHOOSING
+    await update.message.reply_text("Operation cancelled. What next?", reply_markup=markup)
     return CHOOSING
 
-# Main
-def main():
-    app = ApplicationBuilder().token(TOKEN).build()
+# Anything else sent while a render or file batch is running
+async def still_working(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Say why the message is not handled, instead of dropping it silently"""
+    await update.effective_message.reply_text("⏳ Still working on your previous request. Send it again when it's done, or /cancel to stop it.")
+
+# Conversation states and user_data in SQLite
+class SQLitePersistence(BasePersistence):
+    """Only user_data and conversations are stored; bot_data holds live objects like the redirect server
+
+    The application hands over just the users and conversations touched since its last run, every
+    update_interval seconds. Those writes are coalesced and committed in one transaction per run.
+    user_data is loaded per user on their first update, so startup reads nothing but active conversations.
+    """
+    
+    def __init__(self, path: str, update_interval: float = PERSISTENCE_INTERVAL, on_load=None):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+                         update_interval=update_interval)
+        self.path = path
+        self.on_load = on_load  # Called with each user's restored user_data
+        self.connection = None
+        self.loaded_users = set()
+        self.pending_users = {}  # user id -> user_data, or None to delete
+        self.pending_conversations = {}  # (name, key) -> state, or None for ended conversations
+        self.commit_handle = None
+    
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL, updated_at REAL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "name TEXT, key TEXT, state TEXT NOT NULL, updated_at REAL, PRIMARY KEY (name, key))"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at)")
+        return self.connection
+    
+    def schedule_commit(self) -> None:
+        # The application updates every touched user and conversation at once; commit after all of them
+        if self.commit_handle is None:
+            self.commit_handle = asyncio.get_running_loop().call_soon(self.commit)
+    
+    def commit(self) -> None:
+        self.commit_handle = None
+        if not self.pending_users and not self.pending_conversations:
+            return
+        
+        started = time.perf_counter()
+        now = time.time()
+        users, self.pending_users = self.pending_users, {}
+        conversations, self.pending_conversations = self.pending_conversations, {}
+        with self.connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?)",
+                [(user_id, pickle.dumps(data, pickle.HIGHEST_PROTOCOL), now) for user_id, data in users.items() if data is not None]
+            )
+            connection.executemany(
+                "DELETE FROM user_data WHERE user_id = ?", [(user_id,) for user_id, data in users.items() if data is None]
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO conversations (name, key, state, updated_at) VALUES (?, ?, ?, ?)",
+                [(name, key, json.dumps(state), now) for (name, key), state in conversations.items() if state is not None]
+            )
+            connection.executemany(
+                "DELETE FROM conversations WHERE name = ? AND key = ?",
+                [(name, key) for (name, key), state in conversations.items() if state is None]
+            )
+        metrics.increment('persistence.rows', len(users) + len(conversations))
+        metrics.observe('persistence.commit', time.perf_counter() - started)
+    
+    async def get_user_data(self) -> dict:
+        return {}  # Loaded per user by refresh_user_data
+    
+    async def get_chat_data(self) -> dict:
+        return {}
+    
+    async def get_bot_data(self) -> dict:
+        return {}
+    
+    async def get_callback_data(self):
+        return None
+    
+    async def get_conversations(self, name: str) -> dict:
+        connection = self.connect()
+        with connection:
+            connection.execute("DELETE FROM conversations WHERE updated_at <= ?", (time.time() - PERSISTENCE_CONVERSATION_TTL,))
+        rows = connection.execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+    
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        self.pending_conversations[(name, json.dumps(key))] = new_state
+        self.schedule_commit()
+    
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self.pending_users[user_id] = data
+        self.schedule_commit()
+    
+    async def drop_user_data(self, user_id: int) -> None:
+        self.pending_users[user_id] = None
+        self.schedule_commit()
+    
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self.loaded_users:
+            return
+        self.loaded_users.add(user_id)
+        row = self.connect().execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return
+        for key, value in pickle.loads(row[0]).items():
+            user_data.setdefault(key, value)  # Anything set since startup is newer
+        if self.on_load:
+            self.on_load(user_data)
+    
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        pass
+    
+    async def update_bot_data(self, data) -> None:
+        pass
+    
+    async def update_callback_data(self, data) -> None:
+        pass
+    
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+    
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+    
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+    
+    async def flush(self) -> None:
+        if self.commit_handle is not None:
+            self.commit_handle.cancel()
+        self.commit()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+# Semaphores created per key on demand and dropped once nobody holds or waits for them
+class KeyedSemaphores:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.entries = {}  # key -> [semaphore, holders and waiters]
+    
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = [asyncio.Semaphore(self.limit), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.entries[key]
+
+# Concurrent update processing that keeps each user's updates in arrival order
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """One user's updates never overlap, so conversation states can't race; different users run in parallel
+
+    The application starts one task per update in arrival order. Each waits for its user's turn before
+    taking a per-chat and then a global slot, so a user with a backlog holds no slots others could use.
+    """
+    
+    def __init__(self, max_concurrent_updates: int, per_chat_limit: int):
+        super().__init__(UPDATE_MAX_PENDING)  # The base semaphore only admits; limits are applied below
+        self.running = asyncio.Semaphore(max_concurrent_updates)
+        self.users = KeyedSemaphores(1)  # FIFO, so a user's updates run in order
+        self.chats = KeyedSemaphores(per_chat_limit)
+    
+    async def do_process_update(self, update: object, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        chat = update.effective_chat if isinstance(update, Update) else None
+        async with contextlib.AsyncExitStack() as stack:
+            if user is not None:
+                await stack.enter_async_context(self.users.hold(user.id))
+            if chat is not None:
+                await stack.enter_async_context(self.chats.hold(chat.id))
+            await stack.enter_async_context(self.running)
+            await coroutine
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
+
+# Forget job files that did not survive a restart, so the handlers ask for them again
+def drop_lost_workspaces(user_data: dict) -> None:
+    for prefix in ('vinyl', 'video'):
+        workspace = user_data.get(f'{prefix}_workspace')
+        if workspace and not os.path.isdir(workspace):
+            for key in [key for key in user_data if key.startswith(f'{prefix}_')]:
+                user_data.pop(key)
+
+# Telegram webhook endpoint feeding the application's update queue
+class WebhookServer(AsyncHTTPServer):
+    """Acknowledges as soon as the update is queued, so Telegram never waits on handlers"""
+    max_body = WEBHOOK_MAX_BODY
+    
+    def __init__(self, application, host: str, port: int, path: str, secret_token: str, record_path: str = None, fallback=None):
+        super().__init__(host, port)
+        self.application = application
+        self.fallback = fallback  # Server whose handle_request answers every other path, e.g. redirects
+        self.path = path.encode('ascii')
+        self.secret_token = secret_token.encode('ascii')
+        self.record_file = open(record_path, 'a', encoding='utf-8') if record_path else None
+    
+    def handle_request(self, method: bytes, target: bytes, headers: dict, body: bytes) -> tuple:
+        if target.split(b'?', 1)[0] != self.path:
+            if self.fallback:
+                return self.fallback.handle_request(method, target, headers, body)
+            return 404, None
+        if method != b'POST':
+            return 405, None
+        if not hmac.compare_digest(headers.get(b'x-telegram-bot-api-secret-token', b''), self.secret_token):
+            metrics.increment('webhook.rejected')
+            return 403, None
+        
+        try:
+            data = json.loads(body)
+            update = Update.de_json(data, self.application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            metrics.increment('webhook.invalid')
+            return 400, None
+        self.application.update_queue.put_nowait(update)
+        metrics.increment('webhook.updates')
+        
+        if self.record_file:
+            self.record_file.write(json.dumps(data, ensure_ascii=False) + "\n")
+            self.record_file.flush()
+        return 200, None
+    
+    async def close(self) -> None:
+        await super().close()
+        if self.record_file:
+            self.record_file.close()
+            self.record_file = None
+
+# Serve updates over the webhook instead of long polling
+async def run_webhook(app) -> None:
+    """Every instance registers the same URL and secret, so several can run behind a load balancer"""
+    redirects = RedirectServer(local_link_store, WEBHOOK_HOST, WEBHOOK_PORT) if REDIRECTS_ON_WEBHOOK else None
+    server = WebhookServer(
+        app, WEBHOOK_HOST, WEBHOOK_PORT, urlsplit(WEBHOOK_URL).path or '/', WEBHOOK_SECRET, WEBHOOK_RECORD_PATH,
+        fallback=redirects
+    )
+    stop_event = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(signum, stop_event.set)
+    
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    await server.start()
+    await app.bot.set_webhook(
+        WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES,
+        max_connections=WEBHOOK_MAX_CONNECTIONS
+    )
+    print(f"Bot running with webhook{' and redirects' if redirects else ''} on port {server.port}...")
+    try:
+        await stop_event.wait()
+    finally:
+        # The webhook stays registered for the other instances; run_polling removes it when switching back
+        await server.close()
+        await app.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+# Post recorded updates (one JSON object per line) to a webhook and report acknowledgement latency
+def replay_updates(path: str, url: str = None, concurrency: int = 10):
+    return asyncio.run(run_update_replay(path, url, concurrency))
+
+async def run_update_replay(path: str, url: str, concurrency: int) -> dict:
+    """Without url the updates go to a local WebhookServer whose application only queues them"""
+    with open(path, encoding='utf-8') as f:
+        payloads = [line.strip() for line in f if line.strip()]
+    
+    server = None
+    if url is None:
+        server = await WebhookServer(build_application(TOKEN or "0:replay"), '127.0.0.1', 0, '/telegram', WEBHOOK_SECRET).start()
+        url = f"http://127.0.0.1:{server.port}/telegram"
+    
+    statuses = {}
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}
+    
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def post(payload: str):
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post(url, content=payload.encode('utf-8'), headers=headers)
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        
+        started = time.perf_counter()
+        await asyncio.gather(*(post(payload) for payload in payloads))
+        elapsed = time.perf_counter() - started
+    
+    results = {'updates': len(payloads), 'statuses': statuses, 'per_sec': len(payloads) / elapsed}
+    if latencies:
+        latencies.sort()
+        results['ack_p50'] = latencies[len(latencies) // 2]
+        results['ack_p99'] = latencies[int(len(latencies) * 0.99)]
+    if server:
+        results['queued'] = server.application.update_queue.qsize()
+        await server.close()
+    
+    print(f"Replayed {len(payloads)} updates to {url}: statuses {statuses}, {results['per_sec']:.0f}/sec")
+    if latencies:
+        print(f"Acknowledged in p50 {results['ack_p50'] * 1e3:.2f}ms, p99 {results['ack_p99'] * 1e3:.2f}ms")
+    return results
+
+# Build the application with all handlers
+def build_application(token: str = TOKEN):
+    builder = (
+        ApplicationBuilder().token(token)
+        .concurrent_updates(OrderedUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_CHAT_CONCURRENCY))
+        .post_init(start_services).post_shutdown(shutdown_services)
+    )
+    if PERSISTENCE_ENABLED:
+        builder = builder.persistence(SQLitePersistence(PERSISTENCE_PATH, on_load=drop_lost_workspaces))
+    app = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
@@ -863,11 +3907,12 @@ def main():
             ],
             SHORTEN: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, shorten_url),
+                MessageHandler(filters.Document.FileExtension("txt") | filters.Document.FileExtension("csv"), shorten_document, block=False),
                 CommandHandler("menu", menu),
                 CommandHandler("stop", stop),
             ],
             VIDEO: [
-                MessageHandler(filters.VIDEO | filters.Document.VIDEO, process_video),
+                MessageHandler(filters.VIDEO | filters.Document.VIDEO, process_video, block=False),
                 CommandHandler("menu", menu),
                 CommandHandler("stop", stop),
             ],
@@ -877,7 +3922,7 @@ def main():
                 CommandHandler("stop", stop),
             ],
             VINYL_AUDIO: [
-                MessageHandler(filters.AUDIO | filters.VOICE | filters.Document.AUDIO, handle_vinyl_audio),
+                MessageHandler(filters.AUDIO | filters.VOICE | filters.Document.AUDIO, handle_vinyl_audio, block=False),
                 CommandHandler("menu", menu),
                 CommandHandler("stop", stop),
             ],
@@ -911,16 +3956,61 @@ def main():
                 CommandHandler("menu", menu),
                 CommandHandler("stop", stop),
             ],
+            VIDEO_PREVIEW: [
+                CallbackQueryHandler(handle_video_preview, pattern=r"^preview:", block=False),
+                CommandHandler("menu", menu),
+                CommandHandler("stop", stop),
+            ],
+            VINYL_PREVIEW: [
+                CallbackQueryHandler(handle_vinyl_preview, pattern=r"^preview:", block=False),
+                CommandHandler("menu", menu),
+                CommandHandler("stop", stop),
+            ],
+            # Renders and file batches run without blocking the conversation, so these still work meanwhile
+            ConversationHandler.WAITING: [
+                CommandHandler("cancel", cancel),
+                CommandHandler("stop", stop),
+                CommandHandler("stats", stats),
+                MessageHandler(~filters.COMMAND, still_working),
+            ],
         },
         fallbacks=[
             CommandHandler("cancel", cancel),
             CommandHandler("stop", stop),
+            CommandHandler("backend", set_backend),
+            CommandHandler("profile", set_profile),
+            CommandHandler("shortener", set_shortener),
+            CommandHandler("stats", stats),
         ],
+        name="main",
+        persistent=PERSISTENCE_ENABLED,
     )
 
     app.add_handler(conv_handler)
-    print("Bot running...")
-    app.run_polling()
+    # Inline queries have no chat, so they pass through the conversation to here
+    app.add_handler(InlineQueryHandler(inline_shorten, block=False))
+    return app
+
+# Main
+def main():
+    app = build_application()
+    workspaces.purge(WORKSPACE_RESUME_SECONDS if PERSISTENCE_ENABLED else 0)
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(app))
+    else:
+        print("Bot running...")
+        app.run_polling()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "bench-vinyl":
+        benchmark_vinyl_rotation()
+    elif len(sys.argv) > 1 and sys.argv[1] == "bench-redirects":
+        benchmark_redirects()
+    elif len(sys.argv) > 1 and sys.argv[1] == "redirect-server":
+        asyncio.run(serve_redirects())
+    elif len(sys.argv) > 1 and sys.argv[1] == "render-worker":
+        asyncio.run(run_render_queue_worker(render_job_queue, RENDER_WORKERS))
+    elif len(sys.argv) > 2 and sys.argv[1] == "replay-updates":
+        replay_updates(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,239 @@
+"""Shared test setup: a throwaway environment for the bot module and a fake Telegram Bot API"""
+
+import asyncio
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qsl, urlsplit
+
+TEST_ROOT = tempfile.mkdtemp(prefix='smmbot-tests-')
+
+# Set before the bot module reads its configuration at import time
+for name, value in {
+    'TELEGRAM_BOT_TOKEN': '123456:TEST',
+    'PERSISTENCE_ENABLED': '0',
+    'PREVIEW_ENABLED': '0',
+    'WORKSPACE_ROOT': os.path.join(TEST_ROOT, 'workspaces'),
+    'SHORT_LINK_CACHE_PATH': ':memory:',
+    'RENDER_CACHE_PATH': os.path.join(TEST_ROOT, 'render_cache.sqlite3'),
+    'LOCAL_SHORTENER_PATH': os.path.join(TEST_ROOT, 'local_links.sqlite3'),
+    'RENDER_QUEUE_PATH': os.path.join(TEST_ROOT, 'render_queue.sqlite3'),
+    'TINYURL_RATE_LIMIT': '0',
+    'VK_RATE_LIMIT': '0',
+}.items():
+    os.environ.setdefault(name, value)
+
+import telegram
+from telegram import Update
+
+import Sasha_TG_Bot as bot
+
+
+# Stands in for the Bot API: records every call and answers like Telegram would
+class FakeTelegram:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency  # Simulated round trip per call
+        self.calls = []  # (monotonic time, endpoint, data)
+        self.message_ids = 1000
+
+    async def do_post(self, endpoint: str, data: dict, **kwargs):
+        if endpoint == 'getMe':
+            return {'id': 99, 'is_bot': True, 'first_name': 'Bot', 'username': 'test_bot'}
+        self.calls.append((time.monotonic(), endpoint, data))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if endpoint == 'getFile':
+            return {'file_id': data['file_id'], 'file_unique_id': f"u-{data['file_id']}", 'file_path': 'videos/file.mp4'}
+        if endpoint.startswith('send'):
+            self.message_ids += 1
+            message = {
+                'message_id': self.message_ids, 'date': 0, 'text': data.get('text'),
+                'chat': {'id': data['chat_id'], 'type': 'private'},
+            }
+            if endpoint == 'sendVideoNote':
+                message['video_note'] = {'file_id': f"note-{self.message_ids}", 'file_unique_id': f"n{self.message_ids}", 'length': 384, 'duration': 10}
+            return message
+        return True
+
+    def texts(self, chat_id) -> list:
+        return [data.get('text') for _, endpoint, data in self.calls if data.get('chat_id') == chat_id and data.get('text')]
+
+    async def wait_for_text(self, chat_id, fragment: str, after: float = 0.0, timeout: float = 5.0) -> float:
+        """Return when a message containing fragment was sent to chat_id after the given time"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for sent_at, endpoint, data in self.calls:
+                if sent_at >= after and data.get('chat_id') == chat_id and fragment in (data.get('text') or ''):
+                    return sent_at
+            await asyncio.sleep(0.005)
+        raise AssertionError(f"No reply containing {fragment!r} to {chat_id}; got {self.texts(chat_id)}")
+
+
+# Stand-in for RenderWorker: takes render_seconds without blocking the event loop
+class SlowRenderWorker:
+    def __init__(self, render_seconds: float):
+        self.render_seconds = render_seconds
+        self.killed = False
+        self.jobs = []
+
+    @property
+    def alive(self) -> bool:
+        return not self.killed
+
+    async def run(self, job: dict, on_progress=None) -> dict:
+        self.jobs.append(job)
+        steps = 10
+        for step in range(steps):
+            await asyncio.sleep(self.render_seconds / steps)
+            if on_progress and on_progress((step + 1) / steps * 10, 10) is False:
+                self.killed = True  # Like RenderWorker, stop the render the deadline gave up on
+                raise bot.RenderOverBudgetError("Render would miss its deadline")
+        with open(job['output_path'], 'wb') as output:
+            output.write(b'\0' * 1024)
+        return {'duration': 10, 'target_size': 384, 'profile': job['profile'], 'render_seconds': self.render_seconds}
+
+    def kill(self):
+        self.killed = True
+
+    def stop(self):
+        pass
+
+
+def message_update(update_id: int, user_id: int, text: str = None, video: dict = None, document: dict = None) -> dict:
+    message = {
+        'message_id': update_id, 'date': 0,
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"},
+    }
+    if text is not None:
+        message['text'] = text
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    if video is not None:
+        message['video'] = video
+    if document is not None:
+        message['document'] = document
+    return {'update_id': update_id, 'message': message}
+
+
+def video_upload(file_id: str = 'video-1', size: int = 4096) -> dict:
+    return {'file_id': file_id, 'file_unique_id': f"u-{file_id}", 'width': 640, 'height': 360, 'duration': 10, 'file_size': size}
+
+
+# Media info for a landscape H.264 upload that needs a full render
+RENDERABLE_VIDEO_INFO = {
+    'duration': 10.0, 'video_codec': 'h264', 'width': 640, 'height': 360,
+    'pix_fmt': 'yuv420p', 'audio_codec': 'aac', 'rotation': 0,
+}
+
+
+async def fake_probe_media(path: str) -> dict:
+    return dict(RENDERABLE_VIDEO_INFO)
+
+
+async def fake_download_to_drive(self, custom_path=None, **kwargs):
+    with open(custom_path, 'wb') as target:
+        target.write(b'\0' * 4096)
+    return custom_path
+
+
+async def started_application():
+    """Build and start the bot's application; patch_telegram() must be active"""
+    app = bot.build_application()
+    await app.initialize()
+    await app.start()
+    return app
+
+
+async def feed(app, data: dict) -> None:
+    await app.update_queue.put(Update.de_json(data, app.bot))
+
+
+async def stop_application(app) -> None:
+    await app.stop()
+    await app.shutdown()
+
+
+def patch_telegram(fake: FakeTelegram):
+    """Context manager routing every Bot API call to fake"""
+    async def do_post(bot_self, endpoint, data, *args, **kwargs):
+        return await fake.do_post(endpoint, data)
+
+    return mock.patch.object(telegram.Bot, '_do_post', do_post)
+
+
+# Local stand-in for the TinyURL and VK APIs, on a thread so slow answers don't hold up the bot's loop
+class FakeShortenerServer:
+    """Paths: /tinyurl (plain text) and /vk (utils.getShortLink JSON); behaviour is set per path"""
+
+    def __init__(self):
+        self.delays = {}  # Path -> seconds before answering
+        self.statuses = {}  # Path -> HTTP status
+        self.vk_error = None  # VK API error message to answer /vk with
+        self.hits = {}
+        self.codes = itertools.count(1)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                path = urlsplit(self.path).path
+                url = dict(parse_qsl(urlsplit(self.path).query)).get('url', '')
+                server.hits[path] = server.hits.get(path, 0) + 1
+                time.sleep(server.delays.get(path, 0))
+                code = next(server.codes)
+                if path == '/vk':
+                    error = server.vk_error
+                    payload = {'error': {'error_msg': error}} if error else {'response': {'short_url': f"https://vk.cc/c{code}", 'url': url}}
+                    body, content_type = json.dumps(payload).encode(), 'application/json'
+                else:
+                    body, content_type = f"https://tinyurl.com/t{code}".encode(), 'text/plain'
+                self.send_response(server.statuses.get(path, 200))
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def providers(self, timeout: float = 1.0) -> dict:
+        """SHORTENERS pointing at this server, with fresh health and no rate limits"""
+        return {
+            'tinyurl': bot.TinyURLProvider(f"{self.base_url}/tinyurl", timeout),
+            'vk': bot.VKProvider(f"{self.base_url}/vk", timeout, 'test-token', bot.VK_API_VERSION),
+        }
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def use_fake_shorteners(test, fake: FakeShortenerServer, timeout: float = 1.0) -> None:
+    """Route the bot's shortening to fake for the rest of test, with an empty cache and a fresh HTTP pool"""
+    for patcher in (
+        mock.patch.dict(bot.SHORTENERS, fake.providers(timeout)),
+        mock.patch.object(bot, '_http_client', None),
+    ):
+        patcher.start()
+        test.addCleanup(patcher.stop)
+    bot.short_link_cache.memory.clear()
+    with bot.short_link_cache.connect() as connection:
+        connection.execute("DELETE FROM short_links")
+
+    async def close_http_client():
+        if bot._http_client is not None:
+            await bot._http_client.aclose()
+
+    test.addAsyncCleanup(close_http_client)
@@ -0,0 +1,36 @@
+"""Settings commands only accept the values they advertise"""
+
+import unittest
+
+from tests.support import FakeTelegram, feed, message_update, patch_telegram, started_application, stop_application
+
+USER = 7
+
+
+class ProfileCommandTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.telegram = FakeTelegram()
+        patcher = patch_telegram(self.telegram)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.app = await started_application()
+        self.addAsyncCleanup(stop_application, self.app)
+        await feed(self.app, message_update(1, USER, text='/start'))
+        await self.telegram.wait_for_text(USER, 'Welcome')
+
+    async def test_preview_profile_is_not_selectable(self):
+        await feed(self.app, message_update(2, USER, text='/profile preview'))
+        usage = await self.telegram.wait_for_text(USER, 'Usage: /profile')
+
+        self.assertNotIn('encoding_profile', self.app.user_data[USER])
+        reply = next(text for text in self.telegram.texts(USER) if 'Usage: /profile' in text)
+        self.assertNotIn('preview', reply)
+        self.assertIn('quality', reply)
+
+        await feed(self.app, message_update(3, USER, text='/profile fast'))
+        await self.telegram.wait_for_text(USER, 'Encoding profile set to fast', after=usage)
+        self.assertEqual(self.app.user_data[USER]['encoding_profile'], 'fast')
+
+
+if __name__ == '__main__':
+    unittest.main()
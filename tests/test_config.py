@@ -0,0 +1,41 @@
+"""Settings read from the environment at import time"""
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from tests.support import TEST_ROOT
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_settings(names: list, **env) -> dict:
+    """Import the bot module in a fresh interpreter with env added, and return the named settings"""
+    environ = {key: value for key, value in os.environ.items() if key not in ('PORT', 'WEBHOOK_PORT', 'LOCAL_SHORTENER_PORT')}
+    environ.update(env, WORKSPACE_ROOT=os.path.join(TEST_ROOT, 'config-workspaces'))
+    script = f"import json, Sasha_TG_Bot as bot; print(json.dumps({{name: getattr(bot, name) for name in {names!r}}}))"
+    output = subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=environ, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+class PortSettingsTest(unittest.TestCase):
+    def test_webhook_port_setting_wins_over_platform_port(self):
+        self.assertEqual(import_settings(['WEBHOOK_PORT'], PORT='5000', WEBHOOK_PORT='8443')['WEBHOOK_PORT'], 8443)
+        self.assertEqual(import_settings(['WEBHOOK_PORT'], PORT='5000')['WEBHOOK_PORT'], 5000)
+
+    def test_redirect_port_setting_wins_over_platform_port(self):
+        names = ['LOCAL_SHORTENER_PORT', 'WEBHOOK_PORT', 'REDIRECTS_ON_WEBHOOK']
+        env = {'PORT': '5000', 'WEBHOOK_URL': 'https://bot.example/telegram', 'LOCAL_SHORTENER_IN_PROCESS': '1'}
+
+        separate = import_settings(names, LOCAL_SHORTENER_PORT='8080', **env)
+        self.assertEqual(separate, {'LOCAL_SHORTENER_PORT': 8080, 'WEBHOOK_PORT': 5000, 'REDIRECTS_ON_WEBHOOK': False})
+
+        # Neither set explicitly: both take $PORT, and the webhook server answers redirects too
+        shared = import_settings(names, **env)
+        self.assertEqual(shared, {'LOCAL_SHORTENER_PORT': 5000, 'WEBHOOK_PORT': 5000, 'REDIRECTS_ON_WEBHOOK': True})
+
+
+if __name__ == '__main__':
+    unittest.main()
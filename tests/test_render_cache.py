@@ -0,0 +1,61 @@
+"""Rendered video notes are reused only for users asking for the same encoding profile"""
+
+import os
+import unittest
+from unittest import mock
+
+import telegram
+
+from tests.support import (
+    TEST_ROOT, FakeTelegram, SlowRenderWorker, bot, fake_download_to_drive, fake_probe_media, feed,
+    message_update, patch_telegram, started_application, stop_application, video_upload,
+)
+
+
+class RenderCacheProfileTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.fake = FakeTelegram()
+        self.worker = SlowRenderWorker(0.1)
+        cache = bot.RenderCache(os.path.join(TEST_ROOT, f"render_cache_{id(self)}.sqlite3"))
+        for patcher in (
+            patch_telegram(self.fake),
+            mock.patch.object(bot, 'render_scheduler', bot.RenderScheduler(1, worker_factory=lambda: self.worker)),
+            mock.patch.object(bot, 'render_cache', cache),
+            mock.patch.object(bot, 'probe_media', fake_probe_media),
+            mock.patch.object(telegram.File, 'download_to_drive', fake_download_to_drive),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.app = await started_application()
+        self.addAsyncCleanup(stop_application, self.app)
+        self.update_ids = iter(range(1, 1000))
+
+    async def send_video(self, user_id: int, profile: str = None) -> None:
+        steps = [('/start', "Welcome")]
+        if profile:
+            steps.append((f"/profile {profile}", "Encoding profile set"))
+        steps.append(('📷', "Send a video"))
+        for text, fragment in steps:
+            await feed(self.app, message_update(next(self.update_ids), user_id, text=text))
+            await self.fake.wait_for_text(user_id, fragment)
+        await feed(self.app, message_update(next(self.update_ids), user_id, video=video_upload('cached-source')))
+        await self.fake.wait_for_text(user_id, "Video note ready")
+
+    async def test_cached_render_is_keyed_by_profile(self):
+        await self.send_video(1, profile='fast')
+        self.assertEqual([job['profile'] for job in self.worker.jobs], ['fast'])
+
+        await self.send_video(2)  # Default profile: the 'fast' render is not an answer
+        self.assertEqual([job['profile'] for job in self.worker.jobs], ['fast', bot.ENCODING_PROFILE])
+
+        await self.send_video(3, profile='fast')  # Same profile as user 1: resent from the cache
+        self.assertEqual(len(self.worker.jobs), 2)
+        # A cached note is resent by file_id instead of uploading a file
+        notes = [data['video_note'] for _, endpoint, data in self.fake.calls if endpoint == 'sendVideoNote']
+        self.assertEqual(len(notes), 3)
+        self.assertIsInstance(notes[-1], str)
+        self.assertTrue(notes[-1].startswith('note-'), notes[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
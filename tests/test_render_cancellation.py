@@ -0,0 +1,52 @@
+"""/cancel during a render stops it and leaves the conversation at the main menu (user-013)"""
+
+import asyncio
+import unittest
+from unittest import mock
+
+import telegram
+
+from tests.support import (
+    FakeTelegram, SlowRenderWorker, bot, fake_download_to_drive, fake_probe_media, feed,
+    message_update, patch_telegram, started_application, stop_application, video_upload,
+)
+
+
+class RenderCancellationTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.fake = FakeTelegram(latency=0.01)
+        self.worker = SlowRenderWorker(5.0)
+        scheduler = bot.RenderScheduler(1, worker_factory=lambda: self.worker)
+        for patcher in (
+            patch_telegram(self.fake),
+            mock.patch.object(bot, 'render_scheduler', scheduler),
+            mock.patch.object(bot, 'probe_media', fake_probe_media),
+            mock.patch.object(telegram.File, 'download_to_drive', fake_download_to_drive),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.app = await started_application()
+        self.addAsyncCleanup(stop_application, self.app)
+
+    async def test_cancel_mid_render_returns_to_main_menu(self):
+        user = 1
+        await feed(self.app, message_update(1, user, '/start'))
+        await feed(self.app, message_update(2, user, '📷'))
+        await self.fake.wait_for_text(user, "Send a video")
+        await feed(self.app, message_update(3, user, video=video_upload()))
+        while not self.worker.jobs:
+            await asyncio.sleep(0.01)
+
+        await feed(self.app, message_update(4, user, '/cancel'))
+        await self.fake.wait_for_text(user, "Operation cancelled")
+        self.assertTrue(self.worker.killed)
+
+        # The main menu keyboard was shown, so its buttons must work
+        await asyncio.sleep(0.1)
+        await feed(self.app, message_update(5, user, '📷'))
+        await self.fake.wait_for_text(user, "Send a video", after=self.fake.calls[-1][0])
+        self.assertNotIn("Video note ready! Forward it to your channel.", self.fake.texts(user))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+"""Queued renders fail with a clear error when no render-worker process is left to run them (user-025)"""
+
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from tests.support import bot
+
+LEASE = 0.5
+
+
+class QueuedRenderWorkerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        path = os.path.join(tempfile.mkdtemp(), 'render_queue.sqlite3')
+        self.queue = bot.RenderJobQueue(path, LEASE, max_attempts=3)
+        patcher = mock.patch.object(bot, 'RENDER_QUEUE_POLL_INTERVAL', 0.02)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_job_fails_without_workers(self):
+        worker = bot.QueuedRenderWorker(self.queue)
+        with self.assertRaises(bot.RenderWorkersUnavailableError):
+            await asyncio.wait_for(worker.run({'kind': 'video_note'}), LEASE * 4)
+        self.assertIsNone(self.queue.claim('late-worker'))  # Nothing left behind to render
+
+    async def test_job_waits_while_a_worker_is_alive(self):
+        async def busy_worker():
+            while True:
+                self.queue.announce('busy-worker')
+                await asyncio.sleep(LEASE / 5)
+
+        announcer = asyncio.create_task(busy_worker())
+        self.addCleanup(announcer.cancel)
+        run = asyncio.create_task(bot.QueuedRenderWorker(self.queue).run({'kind': 'video_note'}))
+        await asyncio.sleep(LEASE * 3)
+        self.assertFalse(run.done())
+
+        job_id, job = self.queue.claim('busy-worker')
+        self.queue.complete(job_id, 'busy-worker', {'duration': 10, 'target_size': 384})
+        self.assertEqual((await asyncio.wait_for(run, 1))['duration'], 10)
+
+    async def test_job_fails_when_its_only_worker_dies(self):
+        run = asyncio.create_task(bot.QueuedRenderWorker(self.queue).run({'kind': 'video_note'}))
+        self.queue.announce('dying-worker')
+        while self.queue.claim('dying-worker') is None:
+            await asyncio.sleep(0.01)
+        # The worker process dies: no more heartbeats or announcements, the row stays 'running'
+
+        with self.assertRaises(bot.RenderWorkersUnavailableError):
+            await asyncio.wait_for(run, LEASE * 6)
+        self.assertIsNone(self.queue.claim('late-worker'))
+
+    async def test_job_waits_for_a_new_worker_after_a_crash(self):
+        run = asyncio.create_task(bot.QueuedRenderWorker(self.queue).run({'kind': 'video_note'}))
+        self.queue.announce('dying-worker')
+        while self.queue.claim('dying-worker') is None:
+            await asyncio.sleep(0.01)
+
+        # A second worker process is alive: it takes over once the lease runs out
+        async def standby_worker():
+            while True:
+                self.queue.announce('standby-worker')
+                await asyncio.sleep(LEASE / 5)
+
+        announcer = asyncio.create_task(standby_worker())
+        self.addCleanup(announcer.cancel)
+        await asyncio.sleep(LEASE * 3)
+        self.assertFalse(run.done())
+
+        job_id, _ = self.queue.claim('standby-worker')
+        self.queue.complete(job_id, 'standby-worker', {'duration': 10, 'target_size': 384})
+        self.assertEqual((await asyncio.wait_for(run, 1))['duration'], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
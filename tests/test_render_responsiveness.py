@@ -0,0 +1,63 @@
+"""A video note render must not stall the bot for other users (user-008)"""
+
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+import telegram
+
+from tests.support import (
+    FakeTelegram, SlowRenderWorker, bot, fake_download_to_drive, fake_probe_media, feed,
+    message_update, patch_telegram, started_application, stop_application, video_upload,
+)
+
+RENDER_SECONDS = 2.0
+LATENCY_BOUND = 0.5  # Seconds for a reply while another user's render is running
+
+
+class RenderResponsivenessTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.fake = FakeTelegram(latency=0.01)
+        self.worker = SlowRenderWorker(RENDER_SECONDS)
+        scheduler = bot.RenderScheduler(1, worker_factory=lambda: self.worker)
+        for patcher in (
+            patch_telegram(self.fake),
+            mock.patch.object(bot, 'render_scheduler', scheduler),
+            mock.patch.object(bot, 'probe_media', fake_probe_media),
+            mock.patch.object(telegram.File, 'download_to_drive', fake_download_to_drive),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.app = await started_application()
+        self.addAsyncCleanup(stop_application, self.app)
+
+    async def reply_latency(self, update_id: int, user_id: int, text: str, fragment: str) -> float:
+        sent = time.monotonic()
+        await feed(self.app, message_update(update_id, user_id, text))
+        return await self.fake.wait_for_text(user_id, fragment, after=sent) - sent
+
+    async def test_other_users_answered_during_render(self):
+        renderer, other = 1, 2
+        await self.reply_latency(1, renderer, '/start', "Welcome")
+        await self.reply_latency(2, renderer, '📷', "Send a video")
+        await feed(self.app, message_update(3, renderer, video=video_upload()))
+        await self.fake.wait_for_text(renderer, "Processing video")
+        while not self.worker.jobs:
+            await asyncio.sleep(0.01)
+
+        latencies = [
+            await self.reply_latency(10, other, '/start', "Welcome"),
+            await self.reply_latency(11, other, '/menu', "Current State"),
+            await self.reply_latency(12, other, '🔗', "URL"),
+        ]
+        self.assertNotIn("Video note ready! Forward it to your channel.", self.fake.texts(renderer),
+                         "the render finished before the other user was answered")
+        self.assertLess(max(latencies), LATENCY_BOUND, latencies)
+
+        await self.fake.wait_for_text(renderer, "Video note ready", timeout=RENDER_SECONDS + 5)
+        self.assertTrue(any(endpoint == 'sendVideoNote' for _, endpoint, _ in self.fake.calls))
+
+
+if __name__ == '__main__':
+    unittest.main()
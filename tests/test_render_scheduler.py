@@ -0,0 +1,71 @@
+"""RenderScheduler: load-based profile downgrades, queue position updates and cancellation of running renders"""
+
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from tests.support import SlowRenderWorker, bot
+
+
+class RenderSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        for name, value in {'RENDER_DEADLINE_SECONDS': 0, 'ENCODING_FAST_QUEUE_DEPTH': 1}.items():
+            patcher = mock.patch.object(bot, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.workers = []
+        self.scheduler = bot.RenderScheduler(1, worker_factory=self.new_worker)
+
+    def new_worker(self, render_seconds: float = 0.1):
+        worker = SlowRenderWorker(render_seconds)
+        self.workers.append(worker)
+        return worker
+
+    def job(self) -> dict:
+        return {'kind': 'video_note', 'profile': 'quality', 'output_path': os.path.join(tempfile.mkdtemp(), 'out.mp4')}
+
+    async def test_render_downgraded_under_load_is_degraded(self):
+        # The first job starts at once, the second while the third is still waiting, so it gets 'fast'
+        results = await asyncio.gather(*(self.scheduler.run(self.job(), user_id) for user_id in (1, 2, 3)))
+
+        self.assertEqual(sorted(result['profile'] for result in results), ['fast', 'quality', 'quality'])
+        for result in results:
+            self.assertEqual(result.get('degraded', False), result['profile'] == 'fast', result)
+
+    async def test_cancel_kills_the_worker_of_a_restarted_render(self):
+        self.scheduler.worker_factory = lambda: self.new_worker(render_seconds=5)
+        with mock.patch.object(bot, 'RENDER_DEADLINE_SECONDS', 1), mock.patch.object(bot, 'RENDER_DEADLINE_SAMPLE_SECONDS', 0):
+            run = asyncio.create_task(self.scheduler.run(self.job(), 1))
+            while len(self.workers) < 2 or not self.workers[1].jobs:
+                await asyncio.sleep(0.01)
+            run.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await run
+
+        first, restarted = self.workers
+        self.assertEqual(restarted.jobs[0]['max_size'], 240)
+        self.assertTrue(first.killed)
+        self.assertTrue(restarted.killed)
+        self.assertEqual(self.scheduler.running, [])
+
+    async def test_position_updates_arrive_in_order(self):
+        shown = {user_id: [] for user_id in (1, 2, 3)}
+
+        def notifier(user_id):
+            async def on_position(position: int):
+                # The first edit of a message is the slowest to reach Telegram
+                await asyncio.sleep(0.3 if not shown[user_id] and position else 0.01)
+                shown[user_id].append(position)
+            return on_position
+
+        await asyncio.gather(*(self.scheduler.run(self.job(), user_id, notifier(user_id)) for user_id in (1, 2, 3)))
+
+        for user_id, positions in shown.items():
+            self.assertEqual(positions, sorted(positions, reverse=True), f"user {user_id} saw {positions}")
+            self.assertEqual(positions[-1], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+"""Cancelling a user's render on a real RenderWorker wakes the awaiting run() (user-013)"""
+
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+from tests.support import bot
+
+
+def child_pids(pid: int) -> list:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            return [int(child) for child in children.read().split()]
+    except FileNotFoundError:
+        return []
+
+
+def running(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            return stat.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+@unittest.skipUnless(os.path.exists('/proc/self/task'), "needs Linux /proc to find the ffmpeg process")
+class RenderWorkerCancelTest(unittest.IsolatedAsyncioTestCase):
+    async def test_cancel_raises_in_untracked_run(self):
+        # ffmpeg blocks opening a FIFO nobody writes to, so the render runs until it is killed
+        workspace = tempfile.mkdtemp()
+        input_path = os.path.join(workspace, 'input.mp4')
+        os.mkfifo(input_path)
+        job = {
+            'kind': 'video_note', 'input_path': input_path, 'output_path': os.path.join(workspace, 'out.mp4'),
+            'backend': 'ffmpeg', 'profile': 'fast', 'preview': False,
+        }
+        scheduler = bot.RenderScheduler(1)
+        self.addCleanup(scheduler.shutdown)
+
+        run = asyncio.create_task(scheduler.run(job, 1))  # Not track()ed: cancel() can only kill the worker
+        while not scheduler.running or not scheduler.running[0].worker.alive:
+            await asyncio.sleep(0.01)
+        worker = scheduler.running[0].worker
+        deadline = time.monotonic() + 20
+        while not child_pids(worker.process.pid) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        ffmpeg_pids = child_pids(worker.process.pid)
+        self.assertTrue(ffmpeg_pids, "the worker never started ffmpeg")
+        self.assertFalse(run.done())
+
+        started = time.monotonic()
+        self.assertEqual(scheduler.cancel(1), 1)
+        with self.assertRaises(bot.RenderCancelledError):
+            await asyncio.wait_for(run, 5)
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertFalse(worker.process.is_alive())
+        for pid in ffmpeg_pids:
+            self.assertFalse(running(pid), "ffmpeg outlived the cancel")
+        self.assertEqual(scheduler.running, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""Links sent while another is being shortened are answered in order, not dropped (user-018)"""
+
+import asyncio
+import unittest
+from unittest import mock
+
+import telegram
+
+from tests.support import (
+    FakeShortenerServer, FakeTelegram, feed, message_update, patch_telegram, started_application,
+    stop_application, use_fake_shorteners,
+)
+
+USER = 5
+PROVIDER_DELAY = 0.3
+
+
+class ShortenFlowTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.shortener = FakeShortenerServer()
+        self.addCleanup(self.shortener.close)
+        self.shortener.delays['/tinyurl'] = PROVIDER_DELAY
+        use_fake_shorteners(self, self.shortener)
+        self.telegram = FakeTelegram()
+        patcher = patch_telegram(self.telegram)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.app = await started_application()
+        self.addAsyncCleanup(stop_application, self.app)
+        self.update_ids = iter(range(1, 1000))
+        await self.send('/start', "Welcome")
+        await self.send('🔗', "Send the URL")
+
+    async def send(self, text: str, fragment: str = None):
+        await feed(self.app, message_update(next(self.update_ids), USER, text=text))
+        if fragment:
+            await self.telegram.wait_for_text(USER, fragment)
+
+    async def test_messages_during_a_shortening_are_handled_in_order(self):
+        # Sent back to back: the second link arrives while the first is still at the provider
+        for text in ("https://shop.example/one", '🔗', "https://shop.example/two"):
+            await self.send(text)
+
+        deadline = asyncio.get_running_loop().time() + PROVIDER_DELAY * 10
+        while sum('Shortened URL' in text for text in self.telegram.texts(USER)) < 2:
+            self.assertLess(asyncio.get_running_loop().time(), deadline, self.telegram.texts(USER))
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.shortener.hits['/tinyurl'], 2)
+        self.assertEqual(self.telegram.texts(USER)[-1], 'What next?')
+
+    async def test_message_during_a_file_batch_gets_a_reply(self):
+        async def download_as_bytearray(file_self, *args, **kwargs):
+            return bytearray(b"https://shop.example/a\nhttps://shop.example/b\n")
+
+        with mock.patch.object(telegram.File, 'download_as_bytearray', download_as_bytearray):
+            document = {'file_id': 'links', 'file_unique_id': 'u-links', 'file_name': 'links.txt', 'file_size': 64}
+            await feed(self.app, message_update(next(self.update_ids), USER, document=document))
+            await self.telegram.wait_for_text(USER, "Shortening 2 links")
+            await self.send("https://shop.example/c", "Still working on your previous request")
+
+            while not any(endpoint == 'sendDocument' for _, endpoint, _ in self.telegram.calls):
+                await asyncio.sleep(0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
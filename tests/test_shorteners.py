@@ -0,0 +1,86 @@
+"""shorten_link against real HTTP round trips to a local fake TinyURL and VK"""
+
+import asyncio
+import time
+import unittest
+
+from tests.support import FakeShortenerServer, bot, use_fake_shorteners
+
+TIMEOUT = 0.3
+
+
+class ShortenerFallbackTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.server = FakeShortenerServer()
+        self.addCleanup(self.server.close)
+        use_fake_shorteners(self, self.server, timeout=TIMEOUT)
+
+    async def test_vk_timeout_falls_back_to_tinyurl(self):
+        self.server.delays['/vk'] = TIMEOUT * 5
+
+        started = time.monotonic()
+        short_url, provider = await bot.shorten_link("https://shop.example/a", ['vk', 'tinyurl'], hedge=False)
+
+        self.assertEqual(provider, 'TinyURL')
+        self.assertTrue(short_url.startswith('https://tinyurl.com/'), short_url)
+        self.assertLess(time.monotonic() - started, TIMEOUT * 3)
+        self.assertEqual(bot.SHORTENERS['vk'].health.consecutive_failures, 1)
+
+    async def test_slow_vk_is_hedged_with_tinyurl(self):
+        self.server.delays['/vk'] = 2.0
+        bot.SHORTENERS['vk'].timeout = 5.0
+
+        started = time.monotonic()
+        _, provider = await bot.shorten_link("https://shop.example/b", ['vk', 'tinyurl'], hedge=True)
+
+        self.assertEqual(provider, 'TinyURL')
+        self.assertLess(time.monotonic() - started, 2.0)
+
+    async def test_both_failing_reports_each_error(self):
+        self.server.vk_error = 'User authorization failed'
+        self.server.statuses['/tinyurl'] = 503
+
+        with self.assertRaises(bot.ShortenerError) as raised:
+            await bot.shorten_link("https://shop.example/c", ['vk', 'tinyurl'], hedge=False)
+
+        message = str(raised.exception)
+        self.assertIn('VK: VK API unexpected response format: User authorization failed', message)
+        self.assertIn('TinyURL: TinyURL request failed with status 503', message)
+
+    async def test_successful_result_is_cached(self):
+        first = await bot.shorten_link("https://shop.example/d", ['tinyurl'])
+        second = await bot.shorten_link("https://SHOP.example:443/d", ['tinyurl'])
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.server.hits.get('/tinyurl'), 1)
+
+    async def test_unused_fallback_keeps_its_half_open_trial(self):
+        tinyurl = bot.SHORTENERS['tinyurl'].health
+        tinyurl.state, tinyurl.opened_at = 'open', time.monotonic() - bot.SHORTENER_BREAKER_COOLDOWN
+
+        _, provider = await bot.shorten_link("https://shop.example/e", ['vk', 'tinyurl'], hedge=False)
+
+        self.assertEqual(provider, 'VK')
+        self.assertNotIn('/tinyurl', self.server.hits)
+        self.assertFalse(tinyurl.probing)
+        self.assertTrue(tinyurl.available())
+
+    async def test_hedge_is_counted_only_when_a_call_is_made(self):
+        self.server.delays['/vk'] = 1.5
+        bot.SHORTENERS['vk'].timeout = 3.0
+        tinyurl = bot.SHORTENERS['tinyurl'].health
+        tinyurl.state, tinyurl.opened_at = 'open', time.monotonic() - bot.SHORTENER_BREAKER_COOLDOWN
+        hedged = bot.metrics.counters.get('shortener.hedged', 0)
+
+        shortening = asyncio.create_task(bot.shorten_link("https://shop.example/f", ['vk', 'tinyurl'], hedge=True))
+        await asyncio.sleep(0.05)
+        self.assertTrue(tinyurl.allow())  # Another request takes TinyURL's half-open trial first
+
+        _, provider = await shortening
+        self.assertEqual(provider, 'VK')
+        self.assertNotIn('/tinyurl', self.server.hits)
+        self.assertEqual(bot.metrics.counters.get('shortener.hedged', 0), hedged)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""Many users walking through the UTM flow at once keep their own state and don't queue behind each other"""
+
+import asyncio
+import itertools
+import time
+import unittest
+
+from tests.support import (
+    FakeShortenerServer, FakeTelegram, bot, feed, message_update, patch_telegram, started_application,
+    stop_application, use_fake_shorteners,
+)
+
+API_LATENCY = 0.05  # Bot API round trip
+THINK_TIME = 0.1  # A person reading the reply before answering
+USERS = 20
+
+
+def utm_flow(user_id: int) -> list:
+    return ['/start', '🔗 UTM', f"https://shop.example/c{user_id}", 'VK', f"Use: c{user_id}", 'Facebook']
+
+
+class UpdateConcurrencyTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.shortener = FakeShortenerServer()
+        self.addCleanup(self.shortener.close)
+        use_fake_shorteners(self, self.shortener)
+        self.update_ids = itertools.count(1)
+
+    async def run_users(self, user_ids: list) -> float:
+        """Walk every user through the flow concurrently; return the wall time"""
+        self.telegram = FakeTelegram(latency=API_LATENCY)
+        with patch_telegram(self.telegram):
+            app = await started_application()
+            try:
+                started = time.monotonic()
+                await asyncio.wait_for(asyncio.gather(*(self.walk(app, user_id) for user_id in user_ids)), 30)
+                return time.monotonic() - started
+            finally:
+                await stop_application(app)
+
+    async def walk(self, app, user_id: int) -> None:
+        # Send the next step only once the bot has answered the previous one, like a person would
+        for text in utm_flow(user_id):
+            seen = len(self.telegram.texts(user_id))
+            await feed(app, message_update(next(self.update_ids), user_id, text=text))
+            while len(self.telegram.texts(user_id)) == seen:
+                await asyncio.sleep(0.005)
+            await asyncio.sleep(THINK_TIME)
+        await self.telegram.wait_for_text(user_id, 'What next?')
+
+    def assert_flow_completed(self, user_id: int) -> None:
+        replies = self.telegram.texts(user_id)
+        created = [text for text in replies if 'UTM Tracking URL Created' in text]
+        self.assertTrue(replies[0].startswith('Welcome'), replies)
+        self.assertEqual(len(created), 1, replies)
+        self.assertIn(f"shop.example/c{user_id}?utm_source=vk&utm_campaign=c{user_id}", created[0])
+        self.assertEqual(replies[-1], 'What next?')
+
+    async def test_users_keep_their_own_state_and_throughput_scales(self):
+        single = await self.run_users([1])
+        self.assert_flow_completed(1)
+
+        user_ids = list(range(100, 100 + USERS))
+        crowd = await self.run_users(user_ids)
+        for user_id in user_ids:
+            self.assert_flow_completed(user_id)
+        self.assertEqual(self.shortener.hits.get('/tinyurl'), 1 + USERS)
+
+        # Served one after another, USERS users would take USERS times as long as one
+        throughput_ratio = (USERS / crowd) / (1 / single)
+        self.assertGreaterEqual(throughput_ratio, USERS / 4, f"1 user: {single:.2f}s, {USERS} users: {crowd:.2f}s")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+"""The webhook server can share its port with short link redirects (user-023)"""
+
+import json
+import os
+import tempfile
+import unittest
+
+from tests.support import bot
+
+SECRET = 'test-secret'
+
+
+class WebhookRedirectsTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.app = bot.build_application()
+        store = bot.LocalLinkStore(os.path.join(tempfile.mkdtemp(), 'links.sqlite3'), 16)
+        self.code = store.shorten('https://example.com/landing?utm_source=test')
+        redirects = bot.RedirectServer(store, '127.0.0.1', 0)
+        self.server = bot.WebhookServer(self.app, '127.0.0.1', 0, '/telegram', SECRET, fallback=redirects)
+
+    def request(self, method: bytes, target: str, body: bytes = b'', secret: str = SECRET) -> tuple:
+        headers = {b'x-telegram-bot-api-secret-token': secret.encode()}
+        return self.server.handle_request(method, target.encode(), headers, body)
+
+    async def test_updates_and_redirects_on_one_server(self):
+        update = {'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'chat': {'id': 5, 'type': 'private'}, 'text': 'hi'}}
+        self.assertEqual(self.request(b'POST', '/telegram', json.dumps(update).encode()), (200, None))
+        self.assertEqual(self.app.update_queue.qsize(), 1)
+        self.assertEqual(self.request(b'POST', '/telegram', b'{}', secret='wrong'), (403, None))
+
+        status, headers = self.request(b'GET', f'/{self.code}')
+        self.assertEqual((status, headers['Location']), (302, 'https://example.com/landing?utm_source=test'))
+        self.assertEqual(self.request(b'GET', '/unknown')[0], 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+"""Abandoned job workspaces give their files and quota back (user-005)"""
+
+import os
+import tempfile
+import unittest
+
+from tests.support import bot
+
+
+class WorkspaceExpiryTest(unittest.TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.workspaces = bot.JobWorkspaces(root, quota_bytes=100)
+
+    def test_idle_workspace_expires_and_frees_quota(self):
+        abandoned = self.workspaces.create('vinyl')
+        self.workspaces.reserve(abandoned, 80)
+        with self.assertRaises(bot.WorkspaceQuotaError):
+            self.workspaces.reserve(self.workspaces.create('video'), 80)
+
+        self.assertEqual(self.workspaces.expire(3600), 0)
+        self.assertGreaterEqual(self.workspaces.expire(0), 1)
+        self.assertFalse(os.path.isdir(abandoned))
+        self.workspaces.reserve(self.workspaces.create('video'), 80)
+
+    def test_workspace_with_running_job_is_kept(self):
+        rendering = self.workspaces.create('video')
+        self.workspaces.reserve(rendering, 10)
+        with self.workspaces.in_use(rendering):
+            self.assertEqual(self.workspaces.expire(0), 0)
+        self.assertTrue(os.path.isdir(rendering))
+        self.assertEqual(self.workspaces.expire(0), 1)
+
+    def test_session_forgets_expired_workspace(self):
+        workspace = self.workspaces.create('vinyl')
+        user_data = {'vinyl_workspace': workspace, 'vinyl_image_path': os.path.join(workspace, 'cover.jpg')}
+        self.workspaces.expire(0)
+        bot.drop_lost_workspaces(user_data)
+        self.assertEqual(user_data, {})
+
+
+if __name__ == '__main__':
+    unittest.main()